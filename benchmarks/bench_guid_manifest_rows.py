@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Benchmark building a GUID manifest table from GUID service data.
+
+Compares the previous `manifest_guid_data.py` accumulation, which
+concatenated every data structure row onto the whole table and deduplicated
+the whole table after each GUID, with the shared path used now: each GUID's
+rows are collected as records, made into one data frame and deduplicated
+per collection by `process_guid_collections`, and the frames are written
+once. The time per row of the previous accumulation grows with the size of
+the table; the time per row of the shared path stays flat.
+
+Execution:
+bench_guid_manifest_rows.py --guids 250 500 1000 2000 --rows_per_guid 4
+"""
+
+import argparse
+import io
+import logging
+import time
+import warnings
+
+import pandas as pd
+
+import ndasynapse
+
+COLLECTION_ID = "1234"
+MANIFEST_TYPE = "genomics_sample03"
+
+
+def make_guid_data(guid, rows, columns):
+    """Build synthetic GUID service data with `rows` data structure rows."""
+
+    ds_rows = []
+    for row in range(rows):
+        elements = [{'name': "GENOMICS_SAMPLE03_ID", 'value': f"{guid}{row}",
+                     'md5sum': None, 'size': None},
+                    {'name': "SUBJECTKEY", 'value': guid,
+                     'md5sum': None, 'size': None}]
+        elements.extend({'name': f"COLUMN{i}", 'value': f"value_{row}_{i}",
+                         'md5sum': None, 'size': None}
+                        for i in range(columns))
+        ds_rows.append({'datasetId': 11111,
+                        'links': {'link': [{'rel': "collection", 'value': "",
+                                            'href': f"https://nda.nih.gov/edit_collection.html?id={COLLECTION_ID}"}]},
+                        'dataElement': elements})
+
+    return {'guid': guid, 'age': [{'value': 999, 'dataStructureRow': ds_rows}]}
+
+
+def previous_accumulation(all_guid_data):
+    """The per-row concatenation previously in manifest_guid_data.py."""
+
+    all_guids_df = pd.DataFrame()
+
+    for guid_data in all_guid_data:
+        for age_row in guid_data["age"]:
+            for ds_row in age_row["dataStructureRow"]:
+                manifest_data = dict(collection_id=COLLECTION_ID)
+                for de_row in ds_row["dataElement"]:
+                    manifest_data[de_row["name"]] = de_row["value"]
+
+                manifest_flat_df = pd.io.json.json_normalize(manifest_data)
+                all_guids_df = pd.concat([all_guids_df, manifest_flat_df],
+                                         axis=0, ignore_index=True, sort=False)
+
+            manifest_id = (MANIFEST_TYPE + "_id").upper()
+            all_guids_df.drop(manifest_id, axis=1, inplace=True)
+            column_list = (all_guids_df.columns).tolist()
+            all_guids_df = all_guids_df.drop_duplicates(subset=column_list,
+                                                        keep="first")
+
+    out = io.StringIO()
+    all_guids_df.to_csv(out, index=False)
+    return all_guids_df.shape[0]
+
+
+def shared_path(all_guid_data):
+    """Process each GUID once and stream the frames to the output."""
+
+    frames = (data
+              for guid_data in all_guid_data
+              for data in ndasynapse.nda.process_guid_collections(guid_data,
+                                                                  [COLLECTION_ID]))
+    return ndasynapse.output.write_frames(frames, file_format="csv",
+                                          stream=io.StringIO())
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guids", type=int, nargs="+",
+                        default=[250, 500, 1000, 2000])
+    parser.add_argument("--rows_per_guid", type=int, default=4)
+    parser.add_argument("--columns", type=int, default=30)
+
+    args = parser.parse_args()
+
+    logging.getLogger("ndasynapse.nda").setLevel(logging.WARNING)
+    warnings.simplefilter("ignore")
+
+    for guids in args.guids:
+        all_guid_data = [make_guid_data(f"NDAR_{i:011d}", args.rows_per_guid,
+                                        args.columns)
+                         for i in range(guids)]
+        rows = guids * args.rows_per_guid
+
+        results = []
+        for name, func in (("previous", previous_accumulation),
+                           ("shared", shared_path)):
+            start = time.perf_counter()
+            written = func(all_guid_data)
+            seconds = time.perf_counter() - start
+            results.append(f"{name} {seconds:.2f}s "
+                           f"({1e6 * seconds / rows:.0f}us/row, {written} rows)")
+
+        print(f"{rows} rows: {'; '.join(results)}")
+
+
+if __name__ == "__main__":
+    main()
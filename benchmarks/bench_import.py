@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""Benchmark import time of ndasynapse modules and query-nda startup.
+
+Each import runs in a new interpreter with `python -X importtime`, and the
+cumulative time of the top-level import is reported, along with which heavy
+dependencies were imported. The wall time of `query-nda --version` is also
+reported.
+
+Execution:
+bench_import.py --repeat 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+MODULES = ["ndasynapse", "ndasynapse.nda", "ndasynapse.output",
+           "ndasynapse.synapse", "ndasynapse.snapshot"]
+
+HEAVY_DEPENDENCIES = ["pandas", "synapseclient", "boto3", "pyarrow", "deprecated"]
+
+QUERY_NDA = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "bin", "query-nda")
+
+
+def import_time(module):
+    """Get the cumulative import time in seconds and the heavy dependencies imported."""
+
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                         stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        times[name.strip()] = int(cumulative) / 1e6
+
+    imported = [x for x in HEAVY_DEPENDENCIES if x in times]
+    return times[module], imported
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+
+    args = parser.parse_args()
+
+    for module in MODULES:
+        results = [import_time(module) for _ in range(args.repeat)]
+        median = statistics.median(x[0] for x in results)
+        print(f"import {module}: {median:.3f}s, imports {', '.join(results[0][1]) or 'none'}")
+
+    wall = []
+    for _ in range(args.repeat):
+        start = time.time()
+        subprocess.run([sys.executable, QUERY_NDA, "--version"],
+                       stdout=subprocess.DEVNULL, check=True)
+        wall.append(time.time() - start)
+    print(f"query-nda --version: {statistics.median(wall):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Benchmark GUID extraction from a submission manifest.
+
+Compares the full data frame parse used by `get_manifest_file_data` with the
+column-pruned, chunked parse in `get_manifest_guids` on a synthetic
+genomics_sample03 manifest.
+
+Execution:
+bench_manifest_guids.py --rows 200000 --columns 60
+"""
+
+import argparse
+import io
+import timeit
+
+import ndasynapse
+
+
+def make_manifest(rows, columns):
+    """Build the bytes of a synthetic genomics_sample03 manifest."""
+    header = ["subjectkey"] + [f"column{i}" for i in range(columns - 1)]
+    out = io.StringIO()
+    out.write('"genomics_sample","03"\n')
+    out.write(",".join(header) + "\n")
+    for row in range(rows):
+        values = [f"NDAR_{row % 5000:011d}"] + \
+            [f"value_{row}_{i}" for i in range(columns - 1)]
+        out.write(",".join(values) + "\n")
+    return out.getvalue().encode("utf-8")
+
+
+def full_parse(data_files):
+    manifest_df = ndasynapse.nda.get_manifest_file_data(data_files,
+                                                        "genomics_sample")
+    return set(manifest_df["subjectkey"].tolist())
+
+
+def pruned_parse(data_files):
+    return ndasynapse.nda.get_manifest_guids(data_files, "genomics_sample")
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--columns", type=int, default=60)
+    parser.add_argument("--repeat", type=int, default=3)
+
+    args = parser.parse_args()
+
+    data_files = [{'content': make_manifest(args.rows, args.columns)}]
+
+    assert full_parse(data_files) == pruned_parse(data_files)
+
+    for name, func in (("full parse", full_parse),
+                       ("column-pruned parse", pruned_parse)):
+        best = min(timeit.repeat(lambda: func(data_files),
+                                 number=1, repeat=args.repeat))
+        print(f"{name}: {best:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Benchmark the Synapse sync path against tests/fakesynapse.FakeSynapse.
+
+Each fake Synapse call sleeps for a fixed latency to stand in for a round
+trip to Synapse, so the benchmark measures how well
+create_synapse_filehandles and store overlap requests with different
+numbers of threads. Use --failure_rate to check that failures are handled.
+
+Execution:
+bench_store.py --rows 500 --latency 0.02 --parallel 1 4 16
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import pandas
+
+import ndasynapse
+
+# The fake Synapse client is a test helper
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "tests"))
+import fakesynapse  # noqa: E402
+
+
+STORAGE_LOCATION = {'bucket': 'nda-bsmn', 'storageLocationId': 9209}
+
+
+def make_manifest(rows):
+    metadata_manifest = pandas.DataFrame({'data_file': [f"s3://nda-bsmn/abc/file{i}.bam"
+                                                        for i in range(rows)],
+                                          'size': 1,
+                                          'md5': [f"md5{i}" for i in range(rows)]})
+    synapse_manifest = pandas.DataFrame({'name': [f"file{i}.bam" for i in range(rows)],
+                                         'parentId': "syn123"})
+    return metadata_manifest, synapse_manifest
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds per fake Synapse call.")
+    parser.add_argument("--failure_rate", type=float, default=0,
+                        help="Probability that a fake Synapse call fails.")
+    parser.add_argument("--parallel", type=int, nargs="+", default=[1, 4, 16])
+
+    args = parser.parse_args()
+
+    metadata_manifest, synapse_manifest = make_manifest(args.rows)
+
+    for parallel in args.parallel:
+        syn = fakesynapse.FakeSynapse(latency=args.latency,
+                                      failure_rate=args.failure_rate,
+                                      seed=0)
+        start = time.time()
+        try:
+            fh_list = ndasynapse.synapse.create_synapse_filehandles(
+                syn, metadata_manifest, STORAGE_LOCATION, parallel=parallel)
+            filehandle_time = time.time() - start
+
+            synapse_manifest['dataFileHandleId'] = [fh.get('id') for fh in fh_list]
+            f_list = ndasynapse.synapse.store(syn, synapse_manifest, fh_list,
+                                              parallel=parallel, ignore_errors=True)
+        except fakesynapse.FakeSynapseError as e:
+            print(f"parallel={parallel}: failed after {time.time() - start:.2f}s, "
+                  f"calls {dict(syn.calls)}: {e}")
+            continue
+        elapsed = time.time() - start
+
+        print(f"parallel={parallel}: {elapsed:.2f}s ({filehandle_time:.2f}s file handles), "
+              f"{len(f_list)} of {args.rows} rows stored, {len(f_list) / elapsed:.1f} rows/s, "
+              f"calls {dict(syn.calls)}")
+
+if __name__ == "__main__":
+    main()
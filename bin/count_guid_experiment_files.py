@@ -6,7 +6,9 @@ Program: count_guid_experiment_files.py
 Purpose: Uses the output sample file from manifest_guid_data.py to break down 
          the totals of each file type for the given experiment.
 
-Input parameters: Input file
+Input parameters: Input file, or a snapshot directory written by
+                      query-nda snapshot-collections with
+                      --manifest_type genomics_sample03
                   Experiment ID
 
 Outputs: stdout
@@ -18,11 +20,13 @@ import argparse
 import collections
 import pandas as pd
 
+import ndasynapse
+
 def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("guid_input_file", type=argparse.FileType("r"),
-                        help="Sample file created by manifest_guid_data.py")
+    parser.add_argument("guid_input_file", type=str,
+                        help="Sample file created by manifest_guid_data.py ('-' for stdin), or a snapshot directory with a genomics_sample03 table")
     parser.add_argument("experiment_id", type=int,
                         help="Experiment ID")
 
@@ -33,7 +37,8 @@ def main():
     data_type_cols = ["data_file1_type", "data_file2_type", "data_file3_type", "data_file4_type"]
 
     try:
-        file_data_df = pd.read_csv(args.guid_input_file)
+        file_data_df = ndasynapse.snapshot.read_table(args.guid_input_file,
+                                                      "genomics_sample03")
     except Exception as file_read_error:
         raise file_read_error
 
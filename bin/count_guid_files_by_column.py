@@ -7,7 +7,9 @@ Purpose: Uses the output sample file from manifest_guid_data.py to break down
          the totals of each file type for the given experiment by the specified
          column.
 
-Input parameters: Input file
+Input parameters: Input file, or a snapshot directory written by
+                      query-nda snapshot-collections with
+                      --manifest_type genomics_sample03
                   Experiment ID
                   Optional GUID to be removed from the count. It is assumed that
                      the GUID column name is "subjectkey".
@@ -21,11 +23,13 @@ import argparse
 import pandas as pd
 import sys
 
+import ndasynapse
+
 def main():
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("guid_input_file", type=argparse.FileType("r"),
-                        help="Sample file created by manifest_guid_data.py")
+    parser.add_argument("guid_input_file", type=str,
+                        help="Sample file created by manifest_guid_data.py ('-' for stdin), or a snapshot directory with a genomics_sample03 table")
     parser.add_argument("experiment_id", type=int, help="Experiment ID")
     parser.add_argument("column_name", type=str, help="Column name")
     parser.add_argument("--remove_guid", type=str,
@@ -37,7 +41,8 @@ def main():
 
     data_type_cols = ["data_file1_type", "data_file2_type", "data_file3_type", "data_file4_type"]
 
-    file_data_df = pd.read_csv(args.guid_input_file)
+    file_data_df = ndasynapse.snapshot.read_table(args.guid_input_file,
+                                                  "genomics_sample03")
 
     # Convert the column labels to lower case.
     file_data_df.columns = file_data_df.columns.str.lower()
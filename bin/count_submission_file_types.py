@@ -6,7 +6,8 @@ Program: count_submission_file_types.py
 Purpose: Count the number of unique file types (by file extension) in a csv file generated
          by a call to query-nda using the get-submission-files parameter.
 
-Input parameters: csv file name
+Input parameters: csv file name, or a snapshot directory written by
+                      query-nda snapshot-collections
                   Optional file type (Submission Associated File, Submission
                       data file, etc.). For multi-word file types, surround
                       the parameter with double quotes.
@@ -18,22 +19,24 @@ Execution: count_submission_file_types.py <csv file name>
 """
 
 import argparse
-import pandas as pd
 import os
 import sys
 
+import ndasynapse
+
 def main():
 
     parser = argparse.ArgumentParser()
     parser.add_argument("csv_file", type=str,
-                        help="Name of the csv file containing the submission file data")
+                        help="Name of the csv file or snapshot directory containing the submission file data")
     parser.add_argument("--file_type", type=str, default=None,
                         help="value from the file_type field in the csv file")
 
     args = parser.parse_args()
 
     try:
-        file_data_df = pd.read_csv(args.csv_file)
+        file_data_df = ndasynapse.snapshot.read_table(args.csv_file,
+                                                      "submission_files")
     except Exception as file_read_err:
         raise Exception(f"{file_read_err}")
 
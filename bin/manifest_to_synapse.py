@@ -30,10 +30,28 @@ def main():
     parser.add_argument("--ignore_errors", action="store_true", default=False)
     parser.add_argument("--storage_location_id", type=str)
     parser.add_argument("--synapse_data_folder", type=str)
+    parser.add_argument("--parallel", type=int, default=4,
+                        help="Run in parallel threads.")
+    parser.add_argument("--file_view_id", type=str, default=None,
+                        help="File view to look up existing files by md5 in with one query.")
+    parser.add_argument("--md5_index_file", type=str, default=None,
+                        help="File to save the md5 index from --file_view_id in between runs. It is rebuilt if the file view has changed.")
+    parser.add_argument("--refresh_md5_index", action="store_true", default=False,
+                        help="Rebuild the md5 index even if --md5_index_file is up to date.")
+    parser.add_argument("--journal", type=str, default=None,
+                        help="Journal file of stored rows. A rerun with the same journal skips rows that were completed.")
+    parser.add_argument("--skip_unchanged", action="store_true", default=False,
+                        help="Only store files that are new or changed in the file view given by --file_view_id.")
+    ndasynapse.profiling.add_arguments(parser)
     parser.add_argument("manifest_file", type=str)
 
     args = parser.parse_args()
 
+    ndasynapse.profiling.setup(args)
+
+    if args.skip_unchanged and not args.file_view_id:
+        parser.error("--skip_unchanged requires --file_view_id.")
+
     syn = synapseclient.Synapse(skip_checks=True)
     syn.login(silent=True)
 
@@ -42,10 +60,19 @@ def main():
 
     metadata_manifest = pandas.read_csv(args.manifest_file)
 
+    md5_index = None
+    if args.file_view_id:
+        md5_index = ndasynapse.synapse.build_md5_index(syn=syn,
+                                                       file_view_id=args.file_view_id,
+                                                       index_file=args.md5_index_file,
+                                                       refresh=args.refresh_md5_index)
+
     fh_list = ndasynapse.synapse.create_synapse_filehandles(syn=syn,
                                                             metadata_manifest=metadata_manifest,
                                                             storage_location=storage_location,
-                                                            verbose=args.verbose)
+                                                            verbose=args.verbose,
+                                                            parallel=args.parallel,
+                                                            md5_index=md5_index)
     fh_ids = map(lambda x: x.get('id', None), fh_list)
 
     synapse_manifest = metadata_manifest
@@ -66,9 +93,19 @@ def main():
     if not args.dry_run:
         syn = synapseclient.login(silent=True)
 
-        f_list = ndasynapse.synapse.store(syn=syn,
-                                          synapse_manifest=synapse_manifest,
-                                          filehandles=fh_list, ignore_errors=args.ignore_errors)
+        journal = None
+        if args.journal:
+            journal = ndasynapse.synapse.StoreJournal(args.journal)
+
+        try:
+            f_list = ndasynapse.synapse.store(syn=syn,
+                                              synapse_manifest=synapse_manifest,
+                                              filehandles=fh_list, ignore_errors=args.ignore_errors,
+                                              parallel=args.parallel, journal=journal,
+                                              file_view_id=args.file_view_id if args.skip_unchanged else None)
+        finally:
+            if journal is not None:
+                journal.close()
 
         sys.stderr.write("%s\n" % (f_list, ))
     else:
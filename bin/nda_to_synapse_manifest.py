@@ -3,6 +3,7 @@
 import os
 import json
 import logging
+import multiprocessing.dummy
 import uuid
 
 import requests
@@ -33,6 +34,73 @@ NDA_BUCKET_NAME = 'nda-bsmn'
 storage_location_id = '9209'
 PROJECT_ID = 'syn5902559'
 
+def fetch_guid(auth, guid, pool=None):
+    """Get a GUID's samples, subjects and tissues, at the same time with a pool.
+
+    Returns:
+        A tuple of arguments for process_guid, or None if the GUID has no data.
+    """
+
+    data = ndasynapse.nda.get_guid_structures(auth, guid, pool=pool)
+
+    for short_name, guid_data in data.items():
+        if guid_data is None or not guid_data["age"]:
+            logger.warning(f"No {short_name} data for guid {guid}")
+
+    if not any(guid_data and guid_data["age"] for guid_data in data.values()):
+        return None
+
+    return (guid, data["genomics_sample03"], data["genomics_subject02"],
+            data["nichd_btb02"])
+
+
+def process_guid(guid, samples_guid, subjects_guid, btb_guid):
+    """Process a GUID's samples, subjects and tissues into data frames.
+
+    Structures with no data give None. This runs in a worker process.
+    """
+
+    if samples_guid and samples_guid["age"]:
+        samples_guid = ndasynapse.nda.sample_data_files_to_df(samples_guid)
+
+        # exclude some experiments
+        samples_guid = ndasynapse.nda.process_samples(samples_guid)
+        logger.debug(f"Got {samples_guid.shape[0]} samples for {guid}")
+
+        # TEMPORARY FIXES - NEED TO BE ADJUSTED AT NDA
+        try:
+            logger.debug("Fixing Salk site samples still. Check with NDA to confirm change.")
+            samples_guid.loc[samples_guid['site'] == 'Salk', 'site'] = 'U01MH106882'
+        except KeyError:
+            pass
+    else:
+        samples_guid = None
+
+    if subjects_guid and subjects_guid["age"]:
+        subjects_guid = ndasynapse.nda.subjects_to_df(subjects_guid)
+        subjects_guid = ndasynapse.nda.process_subjects(subjects_guid,
+                                                        EXCLUDE_GENOMICS_SUBJECTS)
+    else:
+        subjects_guid = None
+
+    if btb_guid and btb_guid["age"]:
+        btb_guid = ndasynapse.nda.tissues_to_df(btb_guid)
+        btb_guid = ndasynapse.nda.process_tissues(btb_guid)
+    else:
+        btb_guid = None
+
+    return (samples_guid, subjects_guid, btb_guid)
+
+
+def concat(frames):
+    """Concatenate data frames once, skipping missing ones."""
+
+    frames = [x for x in frames if x is not None]
+    if not frames:
+        return pandas.DataFrame()
+    return pandas.concat(frames, sort=False)
+
+
 def main():
 
     import argparse
@@ -45,9 +113,23 @@ def main():
     parser.add_argument("--get_experiments", action="store_true", default=False)
     parser.add_argument("--dataset_ids", default=None, nargs="*")
     parser.add_argument("--config", type=str, default=None)
+    parser.add_argument("--parallel", type=int, default=4,
+                        help="Number of GUIDs to get at the same time.")
+    parser.add_argument("--combine_guid_requests", action="store_true", default=False,
+                        help="Get all of a GUID's data structures in one GUID service request and split them locally, instead of three requests.")
+    parser.add_argument("--processes", type=int, default=0,
+                        help="Worker processes to process GUID data in while it is retrieved. Default is 0, which processes in the retrieving threads.")
+    parser.add_argument("--namespace_uuid", type=str, default=None,
+                        help=f"Namespace UUID for renaming duplicate file names. Default is to get it from the {PROJECT_ID} annotations.")
+    ndasynapse.profiling.add_arguments(parser)
 
     args = parser.parse_args()
 
+    ndasynapse.profiling.setup(args)
+
+    if args.combine_guid_requests:
+        ndasynapse.nda.combine_guid_requests()
+
     config = json.load(open(args.config))
     auth = ndasynapse.nda.authenticate(config)
     logger.info(auth)
@@ -56,37 +138,39 @@ def main():
     # Using the concatenated manifests as the master list of files to store, create file handles and entities in Synapse.
     # Use the metadata table to get the appropriate tissue/subject/sample annotations to set on each File entity.
 
-    samples = pandas.DataFrame()
-    subjects = pandas.DataFrame()
-    btb = pandas.DataFrame()
-    
-    for guid in args.guids:
-        samples_guid = ndasynapse.nda.get_samples(auth, guid=guid)
-        logger.debug(f"Got {len(samples_guid)} samples for {guid}")
-        samples_guid = ndasynapse.nda.sample_data_files_to_df(samples_guid)
-
-        # exclude some experiments
-        samples_guid = ndasynapse.nda.process_samples(samples_guid)
-
-        # TEMPORARY FIXES - NEED TO BE ADJUSTED AT NDA
-        try:
-            logger.debug("Fixing Salk site samples still. Check with NDA to confirm change.")
-            samples_guid.loc[samples_guid['site'] == 'Salk', 'site'] = 'U01MH106882'
-        except KeyError:
-            pass
-        
-        subjects_guid = ndasynapse.nda.get_subjects(auth, guid)
-        subjects_guid = ndasynapse.nda.subjects_to_df(subjects_guid)
-        subjects_guid = ndasynapse.nda.process_subjects(subjects_guid,
-                                                        EXCLUDE_GENOMICS_SUBJECTS)
-        
-        btb_guid = ndasynapse.nda.get_tissues(auth, guid)
-        btb_guid = ndasynapse.nda.tissues_to_df(btb_guid)
-        btb_guid = ndasynapse.nda.process_tissues(btb_guid)
+    # GUIDs are retrieved --parallel at a time, with their three data
+    # structures at the same time in one thread pool for the run, and
+    # processed in --processes worker processes (or in the retrieving
+    # threads).
+    samples = []
+    subjects = []
+    btb = []
 
-        samples = samples.append(samples_guid)
-        subjects = subjects.append(subjects_guid)
-        btb = btb.append(btb_guid)
+    if args.combine_guid_requests:
+        structure_pool = None
+    else:
+        structure_pool = multiprocessing.dummy.Pool(
+            args.parallel * len(ndasynapse.nda.SHORT_NAMES))
+
+    try:
+        guid_frames = ndasynapse.nda.pipeline(
+            args.guids,
+            fetch=lambda guid: fetch_guid(auth, guid, pool=structure_pool),
+            process=process_guid,
+            fetch_parallel=args.parallel,
+            process_parallel=args.processes)
+
+        for samples_guid, subjects_guid, btb_guid in guid_frames:
+            samples.append(samples_guid)
+            subjects.append(subjects_guid)
+            btb.append(btb_guid)
+    finally:
+        if structure_pool is not None:
+            structure_pool.terminate()
+
+    samples = concat(samples)
+    subjects = concat(subjects)
+    btb = concat(btb)
 
     btb_subjects = ndasynapse.nda.merge_tissues_subjects(btb, subjects)    
     metadata = ndasynapse.nda.merge_tissues_samples(btb_subjects, samples)
@@ -125,21 +209,19 @@ def main():
     (good, bad) = ndasynapse.nda.find_duplicate_filenames(metadata)
 
     if bad.shape[0] > 0:
-        syn = synapseclient.login(silent=True)
-
         try:
-            namespace = uuid.UUID(ndasynapse.synapse.get_namespace(syn,
-                                                                   PROJECT_ID))
-            
-            bad_uuids = bad.data_file.apply(lambda x: uuid.uuid3(namespace,
-                                                                 x))
-            bad_slugs = bad_uuids.apply(lambda x: ndasynapse.synapse.uuid2slug(x))
-            bad_slugs.name = 'slug'
-            
-            bad_filename_info = pandas.concat([bad_slugs, bad['basename']], axis=1)
-            fileNameOverride = bad_filename_info.apply(lambda x: '_'.join(map(str, x)), axis=1)
-            
-            bad['fileName'] = fileNameOverride
+            if args.namespace_uuid:
+                namespace = uuid.UUID(args.namespace_uuid)
+            else:
+                syn = synapseclient.login(silent=True)
+                namespace = uuid.UUID(ndasynapse.synapse.get_namespace(syn,
+                                                                       PROJECT_ID))
+
+            bad_slugs = ndasynapse.synapse.slugify_paths(bad.data_file.tolist(),
+                                                         namespace)
+
+            bad['fileName'] = [f"{slug}_{basename}" for (slug, basename)
+                               in zip(bad_slugs, bad['basename'].tolist())]
             good['fileName'] = good['basename']
             
             metadata = pandas.concat([good, bad])
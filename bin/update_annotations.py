@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""Update the annotations of files in Synapse from a metadata manifest.
+
+Only annotations that differ from the given file view are changed, using
+table updates to the file view in chunks instead of storing each file.
+Files are matched by name (the 'fileName' column, or the base name of the
+'data_file' column) in the given folder.
+
+Execution:
+update_annotations.py --file_view_id <Synapse ID> --synapse_data_folder <Synapse ID>
+    <manifest from nda_to_synapse_manifest.py>
+"""
+
+import logging
+import os
+
+import pandas
+import synapseclient
+import ndasynapse
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.DEBUG)
+ch = logging.StreamHandler()
+formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+ch.setLevel(logging.DEBUG)
+logger.addHandler(ch)
+
+
+def main():
+
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry_run", action="store_true", default=False)
+    parser.add_argument("--file_view_id", type=str, required=True,
+                        help="File view including the files to update.")
+    parser.add_argument("--synapse_data_folder", type=str, required=True)
+    parser.add_argument("--chunk_size", type=int, default=1000,
+                        help="Number of files to update in each table transaction.")
+    ndasynapse.profiling.add_arguments(parser)
+    parser.add_argument("manifest_file", type=str)
+
+    args = parser.parse_args()
+
+    ndasynapse.profiling.setup(args)
+
+    syn = synapseclient.Synapse(skip_checks=True)
+    syn.login(silent=True)
+
+    manifest = pandas.read_csv(args.manifest_file)
+
+    try:
+        manifest['name'] = manifest['fileName']
+    except KeyError:
+        logger.info("No column 'fileName', using 'data_file' column.")
+        manifest['name'] = manifest.data_file.apply(os.path.basename)
+
+    manifest['parentId'] = args.synapse_data_folder
+
+    changes = ndasynapse.synapse.update_annotations(syn=syn, manifest=manifest,
+                                                    file_view_id=args.file_view_id,
+                                                    chunk_size=args.chunk_size,
+                                                    dry_run=args.dry_run)
+
+    logger.info("%s files with changed annotations." % (len(changes), ))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,20 @@
-from . import nda
-from . import synapse
+import importlib
+
 from .__version__ import __version__
+
+# Submodules are imported on first use, so that command line tools only
+# import the dependencies (like synapseclient or pyarrow) they need.
+_submodules = ('nda', 'synapse', 'snapshot', 'output', 'metrics', 'profiling',
+               'cache', 'server')
+
+__all__ = list(_submodules) + ['__version__']
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return __all__
@@ -0,0 +1,52 @@
+"""In-memory caches shared by the threads of a long-running process."""
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+    """A thread-safe dictionary that keeps the most recently used items.
+
+    Args:
+        maxsize: Number of items to keep.
+        max_age: Seconds to keep an item for. If None, items do not expire.
+    """
+
+    def __init__(self, maxsize=1024, max_age=None):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                added, value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if self.max_age is not None and time.time() - added > self.max_age:
+                self.misses += 1
+                return default
+
+            self._data[key] = (added, value)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
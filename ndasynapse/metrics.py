@@ -0,0 +1,223 @@
+"""Request and processing stage metrics.
+
+Calls to the NDA and Synapse APIs and the main processing stages record
+their timings in the module-level `metrics` object. Request metrics are
+kept per endpoint: request and error counts, bytes received, status codes
+and latency percentiles. Stage metrics are kept per stage: call counts and
+wall times. Timings are counted in a fixed set of buckets (see Histogram),
+so memory does not grow with the number of requests.
+
+Nothing is recorded until `metrics.enable()` is called. The command line
+tools enable it and write `metrics.summary()` as JSON with `--stats`.
+Timings recorded in worker processes (see ndasynapse.nda.pipeline) stay in
+those processes and are not included.
+
+Synapse calls go through synapseclient, which returns parsed results and
+not the HTTP responses, so only the status codes of failed Synapse calls
+that raise an HTTP error are recorded, and no bytes are.
+
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import math
+import sys
+import threading
+import time
+
+PERCENTILES = (50, 95, 99)
+
+# Histogram buckets start at a microsecond and each is about 9% wider than
+# the last, so reported percentiles are within 9% of the exact values
+BUCKET_MIN = 1e-6
+BUCKET_GROWTH = 2 ** 0.125
+
+
+class Histogram(object):
+    """Counts of timings in fixed, logarithmically spaced buckets.
+
+    A percentile is the upper bound of the bucket it falls in, capped at the
+    largest timing. The count, total and maximum are exact.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+        self._buckets = collections.Counter()
+
+    @staticmethod
+    def _bucket(value):
+        if value <= BUCKET_MIN:
+            return 0
+        return math.ceil(math.log(value / BUCKET_MIN, BUCKET_GROWTH))
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        self.max = value if self.max is None else max(self.max, value)
+        self._buckets[self._bucket(value)] += 1
+
+    def percentile(self, q):
+        """Get the q-th percentile by the nearest-rank method."""
+
+        if not self.count:
+            return None
+
+        rank = max(math.ceil(q / 100.0 * self.count), 1)
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                return min(BUCKET_MIN * BUCKET_GROWTH ** bucket, self.max)
+
+    def summary(self):
+        summary = {'count': self.count,
+                   'total_seconds': self.total,
+                   'max_seconds': self.max}
+        for q in PERCENTILES:
+            summary[f"p{q}_seconds"] = self.percentile(q)
+        return summary
+
+
+class RequestRecord(object):
+    """Details of a request that the caller can fill in; see Metrics.request."""
+
+    def __init__(self):
+        self.status_code = None
+        self.nbytes = 0
+
+
+class Metrics(object):
+    """Thread-safe collection of request and stage timings.
+
+    Args:
+        enabled: Whether to record anything. See `enable`.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        """Start recording metrics."""
+
+        self.reset()
+        self.enabled = True
+
+    def reset(self):
+        """Remove all recorded metrics."""
+
+        with self._lock:
+            self.started = time.time()
+            self._requests = {}
+            self._stages = {}
+
+    def record_request(self, endpoint, seconds, status_code=None, nbytes=0,
+                       error=False):
+        """Record one request to an endpoint."""
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            stats = self._requests.setdefault(endpoint, {'seconds': Histogram(), 'bytes': 0,
+                                                         'errors': 0,
+                                                         'status_codes': {}})
+            stats['seconds'].add(seconds)
+            stats['bytes'] += nbytes or 0
+            stats['errors'] += int(error)
+            if status_code is not None:
+                status_code = str(status_code)
+                stats['status_codes'][status_code] = stats['status_codes'].get(status_code, 0) + 1
+
+    def record_stage(self, stage, seconds):
+        """Record the wall time of one run of a processing stage."""
+
+        if not self.enabled:
+            return
+
+        with self._lock:
+            self._stages.setdefault(stage, Histogram()).add(seconds)
+
+    @contextlib.contextmanager
+    def request(self, endpoint):
+        """Time a request in a `with` block.
+
+        The block can set `status_code` and `nbytes` on the yielded
+        RequestRecord. If the block raises, the request is counted as an
+        error, with the status code of the exception's response if it has one.
+        """
+
+        record = RequestRecord()
+        start = time.time()
+        try:
+            yield record
+        except Exception as e:
+            response = getattr(e, 'response', None)
+            self.record_request(endpoint, time.time() - start,
+                                status_code=getattr(response, 'status_code', None),
+                                error=True)
+            raise
+        else:
+            self.record_request(endpoint, time.time() - start,
+                                status_code=record.status_code,
+                                nbytes=record.nbytes)
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """Time a processing stage in a `with` block."""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record_stage(stage, time.time() - start)
+
+    def summary(self):
+        """Get the metrics as a JSON-serializable dictionary."""
+
+        with self._lock:
+            requests = {endpoint: dict(stats['seconds'].summary(),
+                                       bytes=stats['bytes'],
+                                       errors=stats['errors'],
+                                       status_codes=dict(stats['status_codes']))
+                        for endpoint, stats in self._requests.items()}
+            stages = {stage: seconds.summary()
+                      for stage, seconds in self._stages.items()}
+
+        return {'elapsed_seconds': time.time() - self.started,
+                'requests': requests,
+                'stages': stages}
+
+
+metrics = Metrics(enabled=False)
+
+
+def timed(stage):
+    """Decorate a function to record its wall time as a stage in `metrics`."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def write_stats(path):
+    """Write the metrics summary as JSON to a file, or to stderr if path is '-'."""
+
+    summary = metrics.summary()
+
+    if path == "-":
+        json.dump(summary, sys.stderr, indent=2)
+        sys.stderr.write("\n")
+    else:
+        with open(path, 'w') as stats_file:
+            json.dump(summary, stats_file, indent=2)
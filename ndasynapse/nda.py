@@ -5,17 +5,19 @@
 import io
 import os
 import json
+import shutil
 import logging
+import collections
+import multiprocessing
+import multiprocessing.dummy
+import threading
 import sys
 
 import requests
-import pandas
-import boto3
 from deprecated import deprecated
 
-pandas.options.display.max_rows = None
-pandas.options.display.max_columns = None
-pandas.options.display.max_colwidth = 1000
+from .cache import LRUCache
+from .metrics import metrics, timed
 
 logging.basicConfig()
 logger = logging.getLogger(__name__)
@@ -67,6 +69,52 @@ APPLICATION_SUBTYPE_REPLACEMENTS = {"Whole genome sequencing": "wholeGenomeSeq",
 
 MANIFEST_COLUMNS = ['filename', 'md5', 'size']
 
+# Columns of process_submissions and process_submission_files
+SUBMISSION_COLUMNS = ['collectionid', 'collectiontitle', 'submission_id',
+                      'submission_status', 'dataset_title']
+
+SUBMISSION_FILE_COLUMNS = ['id', 'file_type', 'file_remote_path', 'status',
+                           'md5sum', 'size', 'created_date', 'modified_date']
+
+
+# Long-running processes (like `query-nda serve`) can set a requests.Session
+# to reuse connections, and a cache with get and put methods (like
+# ndasynapse.cache.LRUCache) for successful responses from CACHED_ENDPOINTS.
+session = None
+response_cache = None
+
+CACHED_ENDPOINTS = ('nda.guid', 'nda.guid_data', 'nda.guid_all_data',
+                    'nda.submission', 'nda.submission_files', 'nda.experiment')
+
+# If True, get_guid_data answers each data structure from one request for
+# all of a GUID's data structures, split by short name; see
+# combine_guid_requests. Split responses are kept in guid_data_cache.
+combine_guid_data = False
+guid_data_cache = None
+
+
+def _get(metric_name, url, **kwargs):
+    """Make a GET request, recording its request metrics under a name."""
+
+    cache_key = None
+    if response_cache is not None and metric_name in CACHED_ENDPOINTS:
+        cache_key = (url, json.dumps(kwargs.get('params'), sort_keys=True, default=str))
+        response = response_cache.get(cache_key)
+        if response is not None:
+            return response
+
+    with metrics.request(metric_name) as record:
+        response = (session or requests).get(url, **kwargs)
+        record.status_code = response.status_code
+        content = response.content
+        record.nbytes = len(content) if isinstance(content, bytes) else 0
+
+    if cache_key is not None and response.ok:
+        response_cache.put(cache_key, response)
+
+    return response
+
+
 def authenticate(config):
     """Authenticate to NDA.
 
@@ -97,8 +145,8 @@ def get_guid(auth, subjectkey: str) -> dict:
         dict from JSON format.
     """
 
-    req = requests.get(f"https://nda.nih.gov/api/guid/{subjectkey}/",
-                       auth=auth, headers={'Accept': 'application/json'})
+    req = _get("nda.guid", f"https://nda.nih.gov/api/guid/{subjectkey}/",
+               auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug(f"Request {req} for GUID {subjectkey}")
 
@@ -121,8 +169,38 @@ def get_guid_data(auth, subjectkey: str, short_name: str) -> dict:
         dict from JSON format.
     """
 
-    req = requests.get(f"https://nda.nih.gov/api/guid/{subjectkey}/data?short_name={short_name}",  # pylint: disable=line-too-long
-                       auth=auth, headers={'Accept': 'application/json'})
+    if combine_guid_data:
+        split_data = get_guid_split_data(auth=auth, subjectkey=subjectkey)
+        if split_data is None:
+            return None
+        return split_data.get(short_name, {'guid': subjectkey, 'age': []})
+
+    req = _get("nda.guid_data",
+               f"https://nda.nih.gov/api/guid/{subjectkey}/data?short_name={short_name}",  # pylint: disable=line-too-long
+               auth=auth, headers={'Accept': 'application/json'})
+
+    logger.debug(f"Request {req} for GUID {subjectkey}")
+
+    if req.ok:
+        return req.json()
+    else:
+        logger.debug(f"{req.status_code} - {req.url} - {req.text}")
+        return None
+
+
+def get_guid_all_data(auth, subjectkey: str) -> dict:
+    """Get data of all data structures for a GUID from the GUID API in one request.
+
+    Args:
+        auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+        subjectkey: An NDA GUID (Globally Unique Identifier)
+    Returns:
+        dict from JSON format, with the rows of every data structure.
+    """
+
+    req = _get("nda.guid_all_data",
+               f"https://nda.nih.gov/api/guid/{subjectkey}/data",
+               auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug(f"Request {req} for GUID {subjectkey}")
 
@@ -133,6 +211,75 @@ def get_guid_data(auth, subjectkey: str, short_name: str) -> dict:
         return None
 
 
+def split_guid_data(guid_data: dict) -> dict:
+    """Split GUID API data by the `shortName` of each data structure row.
+
+    Args:
+        guid_data: A dictionary from the output of the NDA GUID service.
+    Returns:
+        A dictionary keyed by short name of GUID service data with only the
+        rows of that data structure, as if requested with its short name.
+    """
+
+    split_data = {}
+
+    for age_data in guid_data["age"]:
+        rows = {}
+        for ds_row in age_data["dataStructureRow"]:
+            rows.setdefault(ds_row.get("shortName"), []).append(ds_row)
+
+        for short_name, short_name_rows in rows.items():
+            short_name_data = split_data.setdefault(short_name, dict(guid_data, age=[]))
+            short_name_data["age"].append(dict(age_data, dataStructureRow=short_name_rows))
+
+    return split_data
+
+
+def get_guid_split_data(auth, subjectkey: str) -> dict:
+    """Get all data of a GUID in one request, split by data structure.
+
+    Results are kept in guid_data_cache if it is set.
+
+    Args:
+        auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+        subjectkey: An NDA GUID (Globally Unique Identifier)
+    Returns:
+        A dictionary from split_guid_data, or None if the request failed.
+    """
+
+    if guid_data_cache is not None:
+        split_data = guid_data_cache.get(subjectkey)
+        if split_data is not None:
+            return split_data
+
+    guid_data = get_guid_all_data(auth=auth, subjectkey=subjectkey)
+    if guid_data is None:
+        return None
+
+    split_data = split_guid_data(guid_data)
+
+    if guid_data_cache is not None:
+        guid_data_cache.put(subjectkey, split_data)
+
+    return split_data
+
+
+def combine_guid_requests(cache_size=1024, max_age=None):
+    """Get each GUID's data structures with one request from now on.
+
+    get_guid_data, and so get_samples, get_subjects and get_tissues, are
+    answered from one request for all of a GUID's data, split by short
+    name, instead of a request per data structure. The split data of the
+    last `cache_size` GUIDs is kept, for up to `max_age` seconds if given,
+    so getting another data structure of a recent GUID does not make a
+    request.
+    """
+
+    global combine_guid_data, guid_data_cache
+    guid_data_cache = LRUCache(maxsize=cache_size, max_age=max_age)
+    combine_guid_data = True
+
+
 def get_samples(auth, guid: str) -> dict:
     """Use the NDA api to get the `genomics_sample03` records for a GUID.
 
@@ -175,6 +322,44 @@ def get_tissues(auth, guid):
     return get_guid_data(auth=auth, subjectkey=guid, short_name="nichd_btb02")
 
 
+def get_guid_structures(auth, guid, short_names=None, pool=None):
+    """Get the GUID API data of several data structures for a GUID.
+
+    With a pool, the data structures are requested at the same time. With
+    combine_guid_requests, they are split from one request instead.
+
+    Args:
+        auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+        guid: An NDA GUID (also called the subjectkey).
+        short_names: The data structures to get. Defaults to SHORT_NAMES.
+        pool: A thread pool to make the requests in, shared by all the GUIDs
+              of a run. If None, they are made one after another.
+    Returns:
+        A dictionary of data in JSON format (or None if the request failed)
+        keyed by short name.
+    """
+
+    if short_names is None:
+        short_names = SHORT_NAMES
+
+    if combine_guid_data:
+        split_data = get_guid_split_data(auth=auth, subjectkey=guid)
+        if split_data is None:
+            return dict.fromkeys(short_names)
+        return {short_name: split_data.get(short_name, {'guid': guid, 'age': []})
+                for short_name in short_names}
+
+    def get_structure(short_name):
+        return get_guid_data(auth=auth, subjectkey=guid, short_name=short_name)
+
+    if pool is None:
+        data = [get_structure(short_name) for short_name in short_names]
+    else:
+        data = pool.map(get_structure, short_names)
+
+    return dict(zip(short_names, data))
+
+
 def get_submission(auth, submissionid: int) -> dict:
     """Use the NDA Submission API to get a submission.
 
@@ -185,8 +370,8 @@ def get_submission(auth, submissionid: int) -> dict:
         dict from JSON format.
     """
 
-    req = requests.get(f"https://nda.nih.gov/api/submission/{submissionid}",
-                       auth=auth, headers={'Accept': 'application/json'})
+    req = _get("nda.submission", f"https://nda.nih.gov/api/submission/{submissionid}",
+               auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug("Request %s for submission %s" % (req, submissionid))
 
@@ -221,11 +406,11 @@ def get_submissions(auth, collectionid, status="Upload Completed", users_own_sub
     if isinstance(collectionid, (list,)):
         collectionid = ",".join(collectionid)
 
-    req = requests.get("https://nda.nih.gov/api/submission/",
-                       params={'usersOwnSubmissions': users_own_submissions,
-                               'collectionId': collectionid,
-                               'status': status},
-                       auth=auth, headers={'Accept': 'application/json'})
+    req = _get("nda.submissions", "https://nda.nih.gov/api/submission/",
+               params={'usersOwnSubmissions': users_own_submissions,
+                       'collectionId': collectionid,
+                       'status': status},
+               auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug("Request %s for collection %s" % (req.url, collectionid))
 
@@ -250,10 +435,11 @@ def get_submission_files(auth, submissionid: int,
 
     """
 
-    req = requests.get(f"https://nda.nih.gov/api/submission/{submissionid}/files",  # pylint: disable=line-too-long
-                       params={'submissionFileStatus': submission_file_status,
-                               'retrieveFilesToUpload': retrieve_files_to_upload},
-                       auth=auth, headers={'Accept': 'application/json'})
+    req = _get("nda.submission_files",
+               f"https://nda.nih.gov/api/submission/{submissionid}/files",  # pylint: disable=line-too-long
+               params={'submissionFileStatus': submission_file_status,
+                       'retrieveFilesToUpload': retrieve_files_to_upload},
+               auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug(f"Request {req.url} for submission {submissionid}")
 
@@ -274,8 +460,8 @@ def get_experiment(auth, experimentid: int) -> dict:
         dict from JSON format.
     """
 
-    req = requests.get(f"https://nda.nih.gov/api/experiment/{experimentid}",
-                       auth=auth, headers={'Accept': 'application/json'})
+    req = _get("nda.experiment", f"https://nda.nih.gov/api/experiment/{experimentid}",
+               auth=auth, headers={'Accept': 'application/json'})
 
     logger.debug(f"Request {req.url} for experiment {experimentid}")
 
@@ -285,6 +471,7 @@ def get_experiment(auth, experimentid: int) -> dict:
         logger.debug(f"{req.status_code} - {req.url} - {req.text}")
         return None
 
+@timed("nda.process_submissions")
 def process_submissions(submission_data):
     """Process NDA submissions from the NDA Submission API.
 
@@ -298,9 +485,11 @@ def process_submissions(submission_data):
         Pandas data frame with submission information.
     """
 
+    import pandas
+
     if submission_data is None:
         logger.debug("No submission data to process.")
-        return pandas.DataFrame()
+        return pandas.DataFrame(columns=SUBMISSION_COLUMNS)
 
     if not isinstance(submission_data, (list,)):
         submission_data = [submission_data]
@@ -311,7 +500,24 @@ def process_submissions(submission_data):
                         submission_status=x['submission_status'],
                         dataset_title=x['dataset_title']) for x in submission_data]  # pylint: disable=line-too-long
 
-    return pandas.DataFrame(submissions)
+    return pandas.DataFrame(submissions, columns=SUBMISSION_COLUMNS)
+
+
+SUBMISSION_FINGERPRINT_KEYS = ('submission_status', 'dataset_created_date',
+                               'dataset_modified_date')
+
+
+def submission_fingerprint(submission: dict) -> str:
+    """Get a fingerprint of a submission to detect changes between syncs.
+
+    Args:
+        submission: A dictionary from the NDA Submission API.
+    Returns:
+        A string built from the submission status and the dataset created
+        and modified dates.
+    """
+
+    return json.dumps([submission.get(key) for key in SUBMISSION_FINGERPRINT_KEYS])
 
 
 def split_bucket_and_key(s3_path):
@@ -351,8 +557,11 @@ def nda_bsmn_location(remote_path, collection_id, submission_id):
     return f"s3://{bucket_and_key['bucket']}/{bucket_and_key['key']}"
 
 
+@timed("nda.process_submission_files")
 def process_submission_files(submission_files):
 
+    import pandas
+
     submission_files_processed = [dict(id=x['id'],
                                        file_type=x['file_type'],
                                        file_remote_path=x['file_remote_path'],
@@ -363,7 +572,8 @@ def process_submission_files(submission_files):
                                        modified_date=x['modified_date'])
                                   for x in submission_files]
 
-    return pandas.DataFrame(submission_files_processed)
+    return pandas.DataFrame(submission_files_processed,
+                            columns=SUBMISSION_FILE_COLUMNS)
 
 
 def get_submission_ids_from_links(data_structure_row: dict) -> set:
@@ -442,6 +652,8 @@ def get_experiment_ids_from_links(data_structure_row: dict) -> set:
 
 @deprecated(reason="This function is deprecated, use the function process_guid_data.")
 def sample_data_files_to_df(guid_data):
+    import pandas
+
     # Get data files from samples.
     tmp = []
 
@@ -480,6 +692,7 @@ SHORT_NAMES = ("genomics_subject02", "nichd_btb02", "genomics_sample03")
 SHORT_NAME_ID_COLS = [f"{short_name}_id".upper() for short_name in SHORT_NAMES]
 
 
+@timed("nda.process_guid_data")
 def process_guid_data(guid_data, collection_ids=None, drop_duplicates=False):
     """Process the GUID data into a data frame.
 
@@ -506,6 +719,8 @@ def process_guid_data(guid_data, collection_ids=None, drop_duplicates=False):
 
     """
 
+    import pandas
+
     data = []
 
     for age_data in guid_data["age"]:
@@ -554,33 +769,217 @@ def process_guid_data(guid_data, collection_ids=None, drop_duplicates=False):
                     manifest_data["%s_md5sum" % (de_row['name'], )] = de_row['md5sum']
                     manifest_data["%s_size" % (de_row['name'], )] = de_row['size']
 
-            manifest_flat_df = pandas.io.json.json_normalize(manifest_data)
-            logger.info(f"{manifest_flat_df.shape[0]} records found for dataset id {dataset_id}, submission id {submission_ids}.")
-            data.append(manifest_flat_df)
+            logger.debug(f"Record found for dataset id {dataset_id}, submission id {submission_ids}.")
+            data.append(manifest_data)
 
-    # Get the manifest data dictionary into a dataframe and
-    # flatten it out if necessary.
-    try:
-        all_guids_df = pandas.concat(data, axis=0, ignore_index=True,
-                                     sort=False)
-    except ValueError:
+    if not data:
         logger.warning(f"No records found.")
         return pandas.DataFrame()
 
     if drop_duplicates:
         # Get rid of any rows that are exact duplicates except for
-        # the manifest ID column
-        drop_cols = [col for col in all_guids_df.columns if col in SHORT_NAME_ID_COLS]  # pylint: disable=line-too-long
-        all_guids_df.drop(drop_cols, axis=1, inplace=True)
-        column_list = (all_guids_df.columns).tolist()
-        all_guids_df = all_guids_df.drop_duplicates(subset=column_list,
-                                                    keep="first")
+        # the manifest ID column. This is done on the records, which is much
+        # faster than on a data frame for the few rows of a GUID.
+        columns = list(dict.fromkeys(col for record in data for col in record
+                                     if col not in SHORT_NAME_ID_COLS))
+        seen = set()
+        unique_data = []
+        for record in data:
+            key = tuple(record.get(col) for col in columns)
+            if key not in seen:
+                seen.add(key)
+                unique_data.append({col: value for col, value in record.items()
+                                    if col not in SHORT_NAME_ID_COLS})
+        data = unique_data
+
+    # Get the manifest data dictionaries into a dataframe in one step and
+    # flatten them out if necessary.
+    all_guids_df = pandas.io.json.json_normalize(data)
 
     return all_guids_df
 
 
+def process_guid_collections(guid_data, collection_ids):
+    """Process the GUID data separately for each of several collections.
+
+    This is a module-level function so that it can run in a worker process.
+
+    Args:
+        guid_data: A dictionary from the output of the NDA GUID service.
+        collection_ids: A list of collection IDs.
+    Returns:
+        A list of data frames from process_guid_data with drop_duplicates,
+        one per collection.
+    """
+
+    return [process_guid_data(guid_data, collection_ids=[int(collection_id)],
+                              drop_duplicates=True)
+            for collection_id in collection_ids]
+
+
+class _PipelineSlot(object):
+    """The state of one item in `pipeline`."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.skipped = False
+        self.result = None
+        self.error = None
+
+
+def _process_context():
+    """Get the multiprocessing context for worker processes.
+
+    Workers are started by a fork server (or spawned where there is none)
+    rather than forked, because callers have thread pools, and in
+    `query-nda serve` other commands, running in this process. A forked
+    child could inherit locks held by those threads, and open sockets.
+    """
+
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+def pipeline(items, fetch, process, fetch_parallel=4, process_parallel=0,
+             max_pending=None):
+    """Fetch items in threads and process them in worker processes at the same time.
+
+    Each item is fetched in a pool of threads, and its processing is queued
+    on a pool of processes as soon as the fetch finishes, so network requests
+    and parsing overlap and parsing can use all cores. At most `max_pending`
+    items are fetched or processed ahead of the caller, which bounds memory
+    if the caller consumes results slowly.
+
+    Args:
+        items: An iterable of items to fetch.
+        fetch: A function taking an item and returning a tuple of arguments
+               for `process`, or None to skip the item. It runs in a thread.
+        process: A module-level function, so that it can be pickled, that
+                 runs in a worker process.
+        fetch_parallel: Number of fetch threads.
+        process_parallel: Number of worker processes. If 0, the default,
+                          items are processed in the fetch threads. If None,
+                          the number of CPUs.
+        max_pending: Maximum number of items in flight. Defaults to twice
+                     the number of threads and processes.
+    Returns:
+        A generator of the results of `process`, in the order of items.
+    """
+
+    if process_parallel is None:
+        process_parallel = os.cpu_count() or 1
+
+    if max_pending is None:
+        max_pending = 2 * (fetch_parallel + max(process_parallel, 1))
+
+    process_pool = None
+    if process_parallel > 0:
+        process_pool = _process_context().Pool(process_parallel)
+    fetch_pool = multiprocessing.dummy.Pool(fetch_parallel)
+
+    def worker(slot, item):
+        try:
+            args = fetch(item)
+            if args is None:
+                slot.skipped = True
+            elif process_pool is None:
+                slot.result = process(*args)
+            else:
+                slot.result = process_pool.apply_async(process, args)
+        except Exception as e:
+            slot.error = e
+        finally:
+            slot.done.set()
+
+    items = iter(items)
+    pending = collections.deque()
+    exhausted = False
+
+    try:
+        while True:
+            while not exhausted and len(pending) < max_pending:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                slot = _PipelineSlot()
+                fetch_pool.apply_async(worker, (slot, item))
+                pending.append(slot)
+
+            if not pending:
+                break
+
+            slot = pending.popleft()
+            slot.done.wait()
+
+            if slot.error is not None:
+                raise slot.error
+            if slot.skipped:
+                continue
+
+            if process_pool is None:
+                yield slot.result
+            else:
+                yield slot.result.get()
+    finally:
+        fetch_pool.terminate()
+        if process_pool is not None:
+            process_pool.terminate()
+
+
+def iter_guid_collection_manifests(auth, collections, manifest_type, parallel=4,
+                                   processes=0):
+    """Get GUID service data of a manifest type for the GUIDs in collections.
+
+    GUIDs are retrieved in threads and their data is processed in worker
+    processes at the same time; see pipeline.
+
+    Args:
+        auth: a requests.auth.HTTPBasicAuth object authenticating to NDA.
+        collections: a list of NDACollection objects.
+        manifest_type: an NDA manifest short name, like 'genomics_sample03'.
+        parallel: number of GUIDs to query at the same time.
+        processes: number of worker processes to process GUID data in; see
+                   the process_parallel argument of `pipeline`.
+    Returns:
+        A generator of pandas data frames of the processed GUID data, one
+        per GUID and collection, yielded as each GUID is processed.
+    """
+
+    # A GUID can be in several collections, so get each one only once.
+    all_guids = sorted(set().union(*[c.guids for c in collections]), key=str)
+
+    def guid_worker(guid):
+        guid_data = get_guid_data(auth=auth, subjectkey=guid,
+                                  short_name=manifest_type)
+
+        # It is possible for there to be no data for the specified
+        # manifest type. If this is the case, the GUID API will return an
+        # OK status (status_code = 200) and an empty data structure, which
+        # will cause the code to crash further down, so check to make sure
+        # that the data structure is not empty before continuing.
+        if guid_data is None or not guid_data["age"]:
+            logger.warning(f"No data for guid {guid}")
+            return None
+
+        collection_ids = [c.collection_id for c in collections if guid in c.guids]
+        return (guid_data, collection_ids)
+
+    for guid_frames in pipeline(all_guids, fetch=guid_worker,
+                                process=process_guid_collections,
+                                fetch_parallel=parallel,
+                                process_parallel=processes):
+        for data in guid_frames:
+            yield data
+
+
+@timed("nda.process_samples")
 def process_samples(samples):
 
+    import pandas
+
     colnames_lower = [x.lower() for x in samples.columns.tolist()]
     samples.columns = colnames_lower
 
@@ -636,8 +1035,19 @@ def process_samples(samples):
     return samples_final
 
 
+def process_guid_samples(guid, guid_data):
+    """Process a GUID's `genomics_sample03` data, adding a `guid` column first."""
+
+    data = process_samples(process_guid_data(guid_data))
+    data.insert(0, 'guid', guid)
+    return data
+
+
+@timed("nda.subjects_to_df")
 def subjects_to_df(json_data):
 
+    import pandas
+
     tmp = []
 
     for row in json_data['age'][0]['dataStructureRow']:
@@ -655,6 +1065,7 @@ def subjects_to_df(json_data):
     return df
 
 
+@timed("nda.process_subjects")
 def process_subjects(df, exclude_genomics_subjects=[]):
     # For some reason there are different ids for this that aren't usable
     # anywhere, so dropping them for now
@@ -682,7 +1093,18 @@ def process_subjects(df, exclude_genomics_subjects=[]):
     return df
 
 
+def process_guid_subjects(guid, guid_data):
+    """Process a GUID's `genomics_subject02` data, adding a `guid` column first."""
+
+    data = process_subjects(subjects_to_df(guid_data))
+    data.insert(0, 'guid', guid)
+    return data
+
+
+@timed("nda.tissues_to_df")
 def tissues_to_df(json_data):
+    import pandas
+
     tmp = []
 
     for row in json_data['age'][0]['dataStructureRow']:
@@ -697,6 +1119,7 @@ def tissues_to_df(json_data):
     return df
 
 
+@timed("nda.process_tissues")
 def process_tissues(df):
     colnames_lower = map(lambda x: x.lower(), df.columns.tolist())
     df.columns = colnames_lower
@@ -740,8 +1163,11 @@ def get_experiments(auth, experiment_ids):
     return df
 
 
+@timed("nda.process_experiments")
 def process_experiments(d):
 
+    import pandas
+
     fix_keys = ['processing.processingKits.processingKit',
                 'additionalinformation.equipment.equipmentName',
                 'extraction.extractionKits.extractionKit',
@@ -787,6 +1213,7 @@ def process_experiments(d):
     return df2
 
 
+@timed("nda.merge_tissues_subjects")
 def merge_tissues_subjects(tissues, subjects):
     """Merge together the tissue file and the subjects file.
 
@@ -812,6 +1239,7 @@ def merge_tissues_subjects(tissues, subjects):
     return btb_subjects
 
 
+@timed("nda.merge_tissues_samples")
 def merge_tissues_samples(btb_subjects, samples):
     """Merge the tissue/subject with the samples to make a complete metadata table."""
 
@@ -836,6 +1264,8 @@ def get_manifests(bucket):
 
     """
 
+    import pandas
+
     objects = bucket.objects.all()
     manifests = [x for x in objects if x.key.find('.manifest') >= 0]
 
@@ -860,6 +1290,7 @@ def get_manifests(bucket):
     return manifest
 
 
+@timed("nda.merge_metadata_manifest")
 def merge_metadata_manifest(metadata, manifest):
     metadata_manifest = manifest.merge(metadata, how="left",
                                        left_on="filename",
@@ -883,6 +1314,8 @@ def find_duplicate_filenames(metadata):
             metadata[basenames.isin(duplicates)])
 
 def get_manifest_file_data(data_files, manifest_type):
+    import pandas
+
     for data_file in data_files:
 
         data_file_as_string = data_file["content"].decode("utf-8")
@@ -894,6 +1327,53 @@ def get_manifest_file_data(data_files, manifest_type):
 
     return None
 
+
+GUID_COLUMN = "subjectkey"
+
+
+def get_manifest_guids(data_files, manifest_type, chunksize=10000):
+    """Get the GUIDs from the first data file matching a manifest type.
+
+    This is a fast path for `get_manifest_file_data` when only the GUIDs
+    are needed. The raw bytes are searched for the manifest type without
+    decoding, and only the subject key column is parsed, in chunks, so
+    large manifests are streamed instead of read into a full data frame.
+
+    Args:
+        data_files: A list of dictionaries with a 'content' key holding the
+                    bytes of a submission data file.
+        manifest_type: An NDA manifest type, like 'genomics_sample'.
+        chunksize: Number of manifest rows to parse at a time.
+    Returns:
+        A set of GUIDs, or None if no data file matches the manifest type.
+    Raises:
+        KeyError: If the matching manifest has no subject key column.
+    """
+
+    import pandas
+
+    manifest_type_bytes = manifest_type.encode("utf-8")
+
+    for data_file in data_files:
+
+        if manifest_type_bytes not in data_file["content"]:
+            continue
+
+        guids = set()
+        reader = pandas.read_csv(io.BytesIO(data_file["content"]),
+                                 skiprows=1, chunksize=chunksize,
+                                 usecols=lambda col: col == GUID_COLUMN)
+
+        for chunk in reader:
+            if GUID_COLUMN not in chunk.columns:
+                raise KeyError(GUID_COLUMN)
+            guids.update(chunk[GUID_COLUMN].tolist())
+
+        return guids
+
+    return None
+
+
 class NDASubmissionFiles:
 
     ASSOCIATED_FILE = 'Submission Associated File'
@@ -906,12 +1386,19 @@ class NDASubmissionFiles:
     logger = logging.getLogger('NDASubmissionFiles')
     logger.setLevel(logging.INFO)
 
-    def __init__(self, auth, files, collection_id, submission_id):
+    def __init__(self, auth, files, collection_id, submission_id,
+                 contents=None):
         self.auth = auth
         self.headers = {'Accept': 'application/json'}
         self.collection_id = str(collection_id)
         self.submission_id = str(submission_id)
 
+        # Downloaded file contents keyed by submission file ID. Contents
+        # passed in (for example, from a saved collection state) are used
+        # instead of downloading the file again.
+        self.contents = dict(contents or {})
+        self.downloaded = set()
+
         (self.associated_files,
          self.data_files,
          self.manifest_file,
@@ -960,10 +1447,22 @@ class NDASubmissionFiles:
                 submission_memento)
 
     def read_file(self, submission_file):
-        download_url = submission_file['_links']['download']['href']
-        request = requests.get(download_url, auth=self.auth)
+        file_id = str(submission_file['id'])
+
+        if file_id not in self.contents:
+            download_url = submission_file['_links']['download']['href']
+            request = _get("nda.download", download_url, auth=self.auth)
+
+            # Only keep successful downloads, so a failed one is tried
+            # again instead of being saved in the collection state
+            if not request.ok:
+                self.logger.error(f"Could not download file {file_id} of submission {self.submission_id}: status {request.status_code}.")
+                return request.content
 
-        return request.content
+            self.contents[file_id] = request.content
+            self.downloaded.add(file_id)
+
+        return self.contents[file_id]
 
     def manifest_to_df(self, short_name):
         """Read the contents of a data file given by the short name.
@@ -973,6 +1472,9 @@ class NDASubmissionFiles:
         Returns:
             Pandas data frame, or None if no data file found.
         """
+
+        import pandas
+
         logger.warning("Information in the submission manifests may be out of date with respect to the NDA database.")
 
         for data_file in self.data_files:
@@ -993,12 +1495,30 @@ class NDASubmission:
     logger = logging.getLogger('NDASubmission')
     logger.setLevel(logging.INFO)
 
-    def __init__(self, auth, submission_id):
+    def __init__(self, auth, submission_id, submission=None, files=None,
+                 contents=None):
+        """Get an NDA submission, its files, and its GUIDs.
+
+        Args:
+            auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+            submission_id: An NDA submission ID.
+            submission: The submission from the NDA Submission API. If None,
+                        it is retrieved.
+            files: The submission files from the NDA Submission API. If None,
+                   they are retrieved.
+            contents: A dictionary of submission file contents keyed by
+                      file ID. Files not in it are downloaded.
+        """
 
         self.auth = auth
         self.submission_id = str(submission_id)
-        self.submission = get_submission(auth=self.auth,
-                                         submissionid=submission_id)
+        self._files = files
+        self._contents = contents
+
+        if submission is None:
+            submission = get_submission(auth=self.auth,
+                                        submissionid=submission_id)
+        self.submission = submission
 
         if self.submission is None:
             self.logger.error(f"Could not retrieve submission {self.submission_id}.")
@@ -1016,8 +1536,10 @@ class NDASubmission:
         submission_id = str(self.submission['submission_id'])
         collection_id = str(self.submission['collection']['id'])
 
-        files = get_submission_files(auth=self.auth,
-                                     submissionid=submission_id)
+        files = self._files
+        if files is None:
+            files = get_submission_files(auth=self.auth,
+                                         submissionid=submission_id)
         processed_files = process_submission_files(submission_files=files)
         processed_files['submission_id'] = submission_id
         processed_files['collection_id'] = collection_id
@@ -1025,13 +1547,61 @@ class NDASubmission:
         sub_files = {'files': NDASubmissionFiles(auth=self.auth,
                                                  files=files,
                                                  collection_id=collection_id,
-                                                 submission_id=submission_id),
+                                                 submission_id=submission_id,
+                                                 contents=self._contents),
+                     'raw_files': files,
                      'processed_files': processed_files,
                      'collection_id': collection_id,
                      'submission_id': submission_id}
 
         return sub_files
 
+    def to_state(self, contents_dir):
+        """Get the submission as a JSON serializable dictionary.
+
+        The state holds everything needed to rebuild the submission
+        without querying NDA; see `from_state`. File contents are not kept
+        in the state. Contents downloaded for this submission are saved in
+        a directory named for the submission under contents_dir, and the
+        state lists their file IDs.
+        """
+
+        submission_files = self.submission_files['files']
+        submission_dir = os.path.join(contents_dir, self.submission_id)
+        os.makedirs(submission_dir, exist_ok=True)
+
+        for file_id in submission_files.downloaded:
+            content_file = os.path.join(submission_dir, file_id)
+            tmp_content_file = f"{content_file}.tmp"
+            with open(tmp_content_file, 'wb') as f:
+                f.write(submission_files.contents[file_id])
+            os.replace(tmp_content_file, content_file)
+
+        return {'fingerprint': submission_fingerprint(self.submission),
+                'submission': self.submission,
+                'files': self.submission_files['raw_files'],
+                'contents': sorted(submission_files.contents)}
+
+    @classmethod
+    def from_state(cls, auth, state, contents_dir):
+        """Rebuild a submission from the output of `to_state`.
+
+        Contents missing from contents_dir are downloaded again.
+        """
+
+        submission_id = str(state['submission']['submission_id'])
+        contents = {}
+        for file_id in state['contents']:
+            content_file = os.path.join(contents_dir, submission_id, file_id)
+            if os.path.exists(content_file):
+                with open(content_file, 'rb') as f:
+                    contents[file_id] = f.read()
+
+        return cls(auth=auth,
+                   submission_id=submission_id,
+                   submission=state['submission'],
+                   files=state['files'],
+                   contents=contents)
 
     def get_guids(self):
         """Get a list of GUIDs for each submission.
@@ -1045,26 +1615,25 @@ class NDASubmission:
         """
         logger.warning("GUID information comes from the submission manifests may be out of date with respect to the NDA database.")
 
-        guids = set()
-
         submission_data_files = self.submission_files["files"].data_files
-        manifest_df = get_manifest_file_data(submission_data_files,
-                                             self._sample_manifest)
-
-        if manifest_df is None:
-            self.logger.debug(f"No {self._sample_manifest} manifest for submission {self.submission_id}. Looking for the {self._subject_manifest} manifest.")
-            manifest_df = get_manifest_file_data(submission_data_files,
-                                                 self._subject_manifest)
 
-        if manifest_df is not None:
-            try:
-                guids_found = manifest_df["subjectkey"].tolist()
-                self.logger.debug(f"Adding {len(guids_found)} GUIDS for submission {self.submission_id}.")
-                guids.update(guids_found)
-            except KeyError:
-                self.logger.error(f"Manifest for submission {self.submission_id} had no guid (subjectkey) column.")
-        else:
+        try:
+            guids = get_manifest_guids(submission_data_files,
+                                       self._sample_manifest)
+
+            if guids is None:
+                self.logger.debug(f"No {self._sample_manifest} manifest for submission {self.submission_id}. Looking for the {self._subject_manifest} manifest.")
+                guids = get_manifest_guids(submission_data_files,
+                                           self._subject_manifest)
+        except KeyError:
+            self.logger.error(f"Manifest for submission {self.submission_id} had no guid (subjectkey) column.")
+            return set()
+
+        if guids is None:
             self.logger.info(f"No manifest with GUIDs found for submission {self.submission_id}")
+            return set()
+
+        self.logger.debug(f"Adding {len(guids)} GUIDS for submission {self.submission_id}.")
 
         return guids
 
@@ -1077,29 +1646,135 @@ class NDACollection(object):
     logger = logging.getLogger('NDACollection')
     logger.setLevel(logging.INFO)
 
-    def __init__(self, auth, collection_id=None):
+    STATE_VERSION = 2
+
+    def __init__(self, auth, collection_id=None, state_file=None,
+                 collection_submissions=None, pool=None):
+        """Get all submissions in an NDA collection.
+
+        Args:
+            auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+            collection_id: An NDA collection ID.
+            state_file: Path to a JSON file with the collection state from a
+                        previous sync. If given, only submissions that are new
+                        or whose status or dataset dates changed are
+                        retrieved, and the file is updated afterwards.
+                        Submission file contents are saved in a directory
+                        next to it; see `contents_dir`.
+            collection_submissions: The collection's submissions from the NDA
+                                    Submission API (see `get_submissions`).
+                                    If None, they are retrieved.
+            pool: A thread pool to retrieve submissions with. If None,
+                  submissions are retrieved one at a time.
+        """
 
         self.auth = auth
         self.collection_id = str(collection_id)
+        self.state_file = state_file
+        self.contents_dir = None
+        if state_file is not None:
+            self.contents_dir = f"{os.path.splitext(state_file)[0]}_contents"
 
-        self._collection_submissions = get_submissions(auth=self.auth,
-                                                       collectionid=self.collection_id)
+        if collection_submissions is None:
+            collection_submissions = get_submissions(auth=self.auth,
+                                                     collectionid=self.collection_id)
+        self._collection_submissions = collection_submissions
 
         self.logger.info(f"Getting {len(self._collection_submissions)} submissions for collection {self.collection_id}.")
 
-        self.submissions = []
+        self._cached_submissions = self.load_state()
+        self._fingerprints = {}
 
-        for coll_sub in self._collection_submissions:
-            if coll_sub is not None:
-                sub = NDASubmission(auth=self.auth,
-                                    submission_id=coll_sub['submission_id'])
-                if sub.submission is not None:
-                    self.submissions.append(sub)
+        coll_subs = [x for x in self._collection_submissions if x is not None]
+        if pool is None:
+            submissions = [self.get_submission(x) for x in coll_subs]
+        else:
+            submissions = pool.map(self.get_submission, coll_subs)
+
+        self.submissions = [sub for sub in submissions
+                            if sub.submission is not None]
 
         self.submission_files = self.get_submission_files()
         self.guids = self.get_guids()
+
+        if self.state_file is not None:
+            self.save_state()
+
         self.logger.info(f"Got collection {self.collection_id}.")
 
+    def get_submission(self, collection_submission):
+        """Get a submission, from the saved state if it has not changed.
+
+        Args:
+            collection_submission: A submission from the collection listing.
+        Returns:
+            An NDASubmission object.
+        """
+
+        submission_id = str(collection_submission['submission_id'])
+        fingerprint = submission_fingerprint(collection_submission)
+        self._fingerprints[submission_id] = fingerprint
+        cached = self._cached_submissions.get(submission_id)
+
+        if cached is not None and cached['fingerprint'] == fingerprint:
+            self.logger.debug(f"Submission {submission_id} is unchanged, using saved state.")
+            return NDASubmission.from_state(auth=self.auth, state=cached,
+                                            contents_dir=self.contents_dir)
+
+        return NDASubmission(auth=self.auth, submission_id=submission_id)
+
+    def load_state(self):
+        """Load the saved submission states for this collection.
+
+        Returns:
+            A dictionary of submission states keyed by submission ID. It is
+            empty if there is no state file or it is for another collection
+            or state version.
+        """
+
+        if self.state_file is None or not os.path.exists(self.state_file):
+            return {}
+
+        with open(self.state_file) as state_file:
+            state = json.load(state_file)
+
+        if state.get('version') != self.STATE_VERSION or \
+                state.get('collection_id') != self.collection_id:
+            self.logger.warning(f"Ignoring state file {self.state_file}, it does not match collection {self.collection_id}.")
+            return {}
+
+        return state['submissions']
+
+    def save_state(self):
+        """Save the state of all submissions in this collection."""
+
+        submissions = {}
+        for sub in self.submissions:
+            submissions[sub.submission_id] = sub.to_state(self.contents_dir)
+            # Compare against the collection listing on the next sync
+            submissions[sub.submission_id]['fingerprint'] = \
+                self._fingerprints.get(sub.submission_id,
+                                       submissions[sub.submission_id]['fingerprint'])
+
+        state = {'version': self.STATE_VERSION,
+                 'collection_id': self.collection_id,
+                 'submissions': submissions}
+
+        os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+
+        tmp_state_file = f"{self.state_file}.tmp"
+        with open(tmp_state_file, 'w') as state_file:
+            json.dump(state, state_file)
+        os.replace(tmp_state_file, self.state_file)
+
+        # Remove the contents of submissions no longer in the collection
+        if not os.path.isdir(self.contents_dir):
+            return
+
+        for submission_id in os.listdir(self.contents_dir):
+            if submission_id not in submissions:
+                shutil.rmtree(os.path.join(self.contents_dir, submission_id))
+
     def get_submission_files(self):
         submission_files = []
         for submission in self.submissions:
@@ -1138,11 +1813,30 @@ class NDACollection(object):
             A pandas data frame of all submission manifests concatenated together.
         """
 
-        logger.warning("Information in the collection manifests may be out of date.")
+        import pandas
 
-        all_data = []
+        all_data = list(self.iter_manifests(manifest_type))
 
-        for submission in self.submissions:
+        if all_data:
+            all_data_df = pandas.concat(all_data, axis=0, ignore_index=True, sort=False)
+            return all_data_df
+
+        return pandas.DataFrame()
+
+    def iter_submissions(self):
+        """Yield the NDASubmission objects of the collection."""
+
+        return iter(self.submissions)
+
+    def iter_manifests(self, manifest_type):
+        """Yield the original manifests of a type, one data frame per submission.
+
+        See get_collection_manifests.
+        """
+
+        logger.warning("Information in the collection manifests may be out of date.")
+
+        for submission in self.iter_submissions():
             logger.debug(f"Getting manifests for submission {submission.submission_id}")
             try:
                 ndafiles = submission.submission_files['files']
@@ -1155,12 +1849,173 @@ class NDACollection(object):
             if manifest_data is not None and manifest_data.shape[0] > 0:
                 manifest_data['collection_id'] = str(self.collection_id)
                 manifest_data['submission_id'] = str(submission.submission_id)
-                all_data.append(manifest_data)
+                yield manifest_data
             else:
                 logger.info(f"No {manifest_type} data found for submission {submission.submission_id}.")
 
-        if all_data:
-            all_data_df = pandas.concat(all_data, axis=0, ignore_index=True, sort=False)
-            return all_data_df
 
-        return pandas.DataFrame()
+def get_collections(auth, collection_ids, parallel=4, state_dir=None):
+    """Get several NDA collections, sharing one submission listing.
+
+    The submissions of all collections are listed with a single call to the
+    NDA Submission API and split by collection ID. All submissions are then
+    retrieved through one shared pool of threads.
+
+    Args:
+        auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+        collection_ids: A list of NDA collection IDs.
+        parallel: Number of submissions to retrieve at the same time.
+        state_dir: A directory to keep a state file for each collection in.
+                   See the state_file argument of NDACollection.
+    Returns:
+        A list of NDACollection objects, in the order of collection_ids.
+    """
+
+    collection_ids = [str(x) for x in collection_ids]
+
+    all_submissions = get_submissions(auth=auth, collectionid=collection_ids)
+
+    if all_submissions is None:
+        logger.error(f"Could not retrieve submissions for collections {collection_ids}.")
+        all_submissions = []
+
+    collection_submissions = {collection_id: [] for collection_id in collection_ids}
+    for submission in all_submissions:
+        if submission is not None:
+            collection_id = str(submission['collection']['id'])
+            collection_submissions.setdefault(collection_id, []).append(submission)
+
+    submission_pool = multiprocessing.dummy.Pool(parallel)
+    # Collections are built in their own threads so that their submissions
+    # are queued on the shared pool together.
+    collection_pool = multiprocessing.dummy.Pool(max(len(collection_ids), 1))
+
+    def collection_worker(collection_id):
+        state_file = None
+        if state_dir is not None:
+            state_file = os.path.join(state_dir,
+                                      f"collection_{collection_id}.json")
+
+        return NDACollection(auth=auth, collection_id=collection_id,
+                             state_file=state_file,
+                             collection_submissions=collection_submissions[collection_id],
+                             pool=submission_pool)
+
+    try:
+        return collection_pool.map(collection_worker, collection_ids)
+    finally:
+        collection_pool.terminate()
+        submission_pool.terminate()
+
+
+class LazyNDACollection(object):
+    """An NDA collection that retrieves its submissions only when iterated.
+
+    Unlike NDACollection, the constructor does not query NDA. Submissions
+    are retrieved in parallel threads and yielded as each one completes,
+    so callers can process them while others are still downloading, or
+    stop early.
+
+    """
+
+    logger = logging.getLogger('LazyNDACollection')
+    logger.setLevel(logging.INFO)
+
+    def __init__(self, auth, collection_id, parallel=4):
+        """
+        Args:
+            auth: a requests.auth.HTTPBasicAuth object to connect to NDA.
+            collection_id: An NDA collection ID.
+            parallel: Number of submissions to retrieve at the same time.
+        """
+
+        self.auth = auth
+        self.collection_id = str(collection_id)
+        self.parallel = parallel
+
+    def __iter__(self):
+        return self.iter_submissions()
+
+    def get_collection_submissions(self):
+        """Get the list of submissions in the collection from NDA."""
+
+        collection_submissions = get_submissions(auth=self.auth,
+                                                 collectionid=self.collection_id)
+
+        if collection_submissions is None:
+            self.logger.error(f"Could not retrieve submissions for collection {self.collection_id}.")
+            return []
+
+        return [x for x in collection_submissions if x is not None]
+
+    def _get_submission(self, collection_submission):
+        return NDASubmission(auth=self.auth,
+                             submission_id=collection_submission['submission_id'])
+
+    def iter_submissions(self):
+        """Yield NDASubmission objects in the order they are retrieved."""
+
+        collection_submissions = self.get_collection_submissions()
+
+        self.logger.info(f"Getting {len(collection_submissions)} submissions for collection {self.collection_id}.")
+
+        pool = multiprocessing.dummy.Pool(self.parallel)
+
+        try:
+            for submission in pool.imap_unordered(self._get_submission,
+                                                  collection_submissions):
+                if submission.submission is not None:
+                    yield submission
+        finally:
+            # Stops outstanding work if the caller stops iterating early
+            pool.terminate()
+
+    def iter_guids(self):
+        """Yield each GUID in the collection once, as submissions are retrieved.
+
+        See NDASubmission.get_guids for caveats.
+        """
+
+        seen = set()
+
+        for submission in self.iter_submissions():
+            for guid in submission.guids:
+                if guid not in seen:
+                    seen.add(guid)
+                    yield guid
+
+    def iter_manifest_rows(self, short_name):
+        """Yield rows of the original manifests of a type, one submission at a time.
+
+        Args:
+            short_name: An NDA manifest type, like 'genomics_sample'.
+        Returns:
+            A generator of dictionaries, one per manifest row, with
+            'collection_id' and 'submission_id' added.
+        """
+
+        for manifest_data in self.iter_manifests(short_name):
+            for row in manifest_data.to_dict(orient='records'):
+                yield row
+
+    def iter_manifests(self, short_name):
+        """Yield the original manifests of a type, one data frame per submission.
+
+        Args:
+            short_name: An NDA manifest type, like 'genomics_sample'.
+        Returns:
+            A generator of data frames with 'collection_id' and
+            'submission_id' columns added.
+        """
+
+        for submission in self.iter_submissions():
+            manifest_data = submission.submission_files['files'].manifest_to_df(short_name)
+
+            if manifest_data is None or manifest_data.shape[0] == 0:
+                self.logger.info(f"No {short_name} data found for submission {submission.submission_id}.")
+                continue
+
+            manifest_data['collection_id'] = self.collection_id
+            manifest_data['submission_id'] = submission.submission_id
+
+            yield manifest_data
@@ -0,0 +1,230 @@
+"""Write tables to a file as they are produced.
+
+A RowWriter takes data frames one at a time (for example, the rows for one
+GUID or one submission), so only one frame has to be kept in memory.
+
+Frames do not need to have the same columns. The output has the union of
+columns in the order they are first seen, with missing values left empty,
+as with pandas.concat. JSON Lines records have no shared header, so they
+are written immediately and late columns are kept from the first record
+they appear in. CSV and Parquet outputs have a single header or schema that
+must list every column, so their frames are spooled to a temporary file and
+written with the final columns when the writer is closed. If `columns` is
+given, CSV and Parquet frames are written immediately with those columns
+and any other columns are dropped with a warning.
+
+Parquet output requires the optional `pyarrow` package.
+
+"""
+
+import abc
+import csv
+import logging
+import pickle
+import sys
+import tempfile
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+FORMATS = ('csv', 'jsonl', 'parquet')
+
+
+class RowWriter(abc.ABC):
+    """Write data frames to a stream with the union of their columns.
+
+    Args:
+        stream: A file object to write to.
+        columns: The output columns. If None, the union of the columns of
+                 all frames written.
+    """
+
+    # Whether frames can be written before all columns are known
+    extend_columns = False
+
+    def __init__(self, stream, columns=None):
+        self.stream = stream
+        self.fixed_columns = columns is not None
+        self.columns = list(columns) if columns is not None else []
+        self.rows = 0
+        self._dropped = set()
+        self._spool = None
+
+    def _add_columns(self, df):
+        new_columns = [x for x in df.columns if x not in self.columns]
+
+        if not self.fixed_columns:
+            self.columns.extend(new_columns)
+            return
+
+        dropped = [x for x in new_columns if x not in self._dropped]
+        if dropped:
+            logger.warning(f"Dropping columns {dropped} that are not in the output columns.")
+            self._dropped.update(dropped)
+
+    def write(self, df):
+        """Write the rows of a data frame. Empty frames are skipped."""
+
+        if df is None or df.shape[0] == 0:
+            return
+
+        self._add_columns(df)
+        self._seen(df)
+
+        if self.fixed_columns or self.extend_columns:
+            self._write(df.reindex(columns=self.columns))
+        else:
+            if self._spool is None:
+                self._spool = tempfile.TemporaryFile()
+            pickle.dump(df, self._spool, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.rows += df.shape[0]
+
+    def _seen(self, df):
+        """Called with each frame before it is written or spooled."""
+
+    @abc.abstractmethod
+    def _write(self, df):
+        """Write a data frame that has the output columns."""
+
+    def close(self):
+        """Finish the output. The stream itself is not closed."""
+
+        if self._spool is not None:
+            self._spool.seek(0)
+            while True:
+                try:
+                    df = pickle.load(self._spool)
+                except EOFError:
+                    break
+                self._write(df.reindex(columns=self.columns))
+            self._spool.close()
+            self._spool = None
+
+        self.stream.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class CSVRowWriter(RowWriter):
+
+    def __init__(self, stream, columns=None):
+        super(CSVRowWriter, self).__init__(stream=stream, columns=columns)
+        self._header = True
+
+    def _write(self, df):
+        df.to_csv(self.stream, index=False, header=self._header,
+                  quoting=csv.QUOTE_NONNUMERIC)
+        self._header = False
+        self.stream.flush()
+
+
+class JSONLRowWriter(RowWriter):
+
+    extend_columns = True
+
+    def _write(self, df):
+        records = df.to_json(orient='records', lines=True)
+        if not records.endswith("\n"):
+            records += "\n"
+        self.stream.write(records)
+        self.stream.flush()
+
+
+class ParquetRowWriter(RowWriter):
+    """Write each data frame as a row group of a Parquet file.
+
+    The schema unifies the types of each column in all frames (or in the
+    first frame, if `columns` is given). Columns with no values are written
+    as strings.
+    """
+
+    def __init__(self, stream, columns=None):
+        super(ParquetRowWriter, self).__init__(stream=stream, columns=columns)
+
+        # Imported here so that pyarrow is only needed for Parquet output
+        from .snapshot import _import_pyarrow
+        self._pyarrow = _import_pyarrow()
+        self._writer = None
+        self._schema = None
+        self._schemas = []
+
+    def _seen(self, df):
+        if not self.fixed_columns:
+            self._schemas.append(self._pyarrow.Schema.from_pandas(df, preserve_index=False))
+
+    def _write(self, df):
+        pyarrow = self._pyarrow
+
+        if self._writer is None:
+            if self._schemas:
+                schema = pyarrow.unify_schemas(self._schemas)
+            else:
+                schema = pyarrow.Schema.from_pandas(df, preserve_index=False)
+            fields = [schema.field(x) if x in schema.names else pyarrow.field(x, pyarrow.null())
+                      for x in self.columns]
+            self._schema = pyarrow.schema(
+                [field.with_type(pyarrow.string()) if pyarrow.types.is_null(field.type)
+                 else field for field in fields])
+            self._writer = pyarrow.parquet.ParquetWriter(self.stream, self._schema)
+
+        table = pyarrow.Table.from_pandas(df, schema=self._schema, preserve_index=False)
+        self._writer.write_table(table)
+
+    def close(self):
+        super(ParquetRowWriter, self).close()
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+            self.stream.flush()
+
+
+WRITERS = {'csv': CSVRowWriter, 'jsonl': JSONLRowWriter, 'parquet': ParquetRowWriter}
+
+
+def open_writer(file_format="csv", stream=None, columns=None):
+    """Make a RowWriter for an output format.
+
+    Args:
+        file_format: One of 'csv', 'jsonl' or 'parquet'.
+        stream: A file object to write to. Defaults to standard output.
+                Parquet is written to the binary buffer of text streams.
+        columns: The output columns; see RowWriter.
+    Returns:
+        A RowWriter.
+    """
+
+    if file_format not in WRITERS:
+        raise ValueError(f"Unknown output format {file_format}, use one of {list(FORMATS)}.")
+
+    if stream is None:
+        stream = sys.stdout
+
+    if file_format == "parquet":
+        stream = getattr(stream, 'buffer', stream)
+
+    return WRITERS[file_format](stream=stream, columns=columns)
+
+
+def write_frames(frames, file_format="csv", stream=None, columns=None):
+    """Write data frames from an iterable, with the union of their columns.
+
+    JSON Lines rows, and CSV and Parquet rows with `columns`, are written
+    as each frame is produced. Otherwise CSV and Parquet rows are written
+    when the frames run out. See RowWriter.
+
+    Returns:
+        The number of rows written.
+    """
+
+    with open_writer(file_format=file_format, stream=stream,
+                     columns=columns) as writer:
+        for df in frames:
+            writer.write(df)
+
+    return writer.rows
@@ -0,0 +1,203 @@
+"""Profile command line runs.
+
+`start('cpu')` runs the rest of the process under cProfile, with a separate
+profile for every thread started afterwards (such as the thread pools used
+to query NDA and Synapse), and reports the hottest functions on exit.
+`start('memory')` traces allocations with tracemalloc and reports the top
+allocation sites on exit. Both reports also list the ndasynapse functions
+or lines separately.
+
+Work done in worker processes (see ndasynapse.nda.pipeline) is not
+profiled.
+
+From Python 3.12, cProfile uses sys.monitoring. It allows only one active
+profile per process, and that profile sees every thread, so a single
+profile is used instead of one per thread.
+
+The command line tools add `--stats`, `--profile` and `--profile_output`
+with `add_arguments(parser)` and act on them with `setup(args)`.
+
+"""
+
+import atexit
+import cProfile
+import io
+import pstats
+import sys
+import threading
+import tracemalloc
+
+from . import metrics
+
+PROFILERS = ('cpu', 'memory')
+
+# Only functions and lines in files matching this are in the package sections
+PACKAGE_PATTERN = "ndasynapse"
+
+# A cProfile profile covers every thread, and only one can be enabled
+PROFILE_PER_PROCESS = sys.version_info >= (3, 12)
+
+
+class CPUProfiler(object):
+    """cProfile the current thread and every thread started after `start`.
+
+    Before Python 3.12 each thread gets its own profile, which are combined
+    in the report. From 3.12 one profile covers all threads.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self._lock = threading.Lock()
+
+    def _enable(self):
+        profile = cProfile.Profile()
+        with self._lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def _thread_hook(self, frame, event, arg):
+        # Called on the first event in a new thread. Enabling the profile
+        # replaces this hook for the thread.
+        self._enable()
+
+    def start(self):
+        if not PROFILE_PER_PROCESS:
+            threading.setprofile(self._thread_hook)
+        self._enable()
+
+    def stop(self):
+        if not PROFILE_PER_PROCESS:
+            threading.setprofile(None)
+        with self._lock:
+            profiles = list(self.profiles)
+        for profile in profiles:
+            profile.disable()
+
+    def stats(self):
+        """Get the combined pstats.Stats of all threads."""
+
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profiles[0], stream=stream)
+        for profile in self.profiles[1:]:
+            stats.add(profile)
+        return stats, stream
+
+    def report(self, limit=30):
+        stats, stream = self.stats()
+
+        if PROFILE_PER_PROCESS:
+            stream.write("CPU profile of all threads\n")
+        else:
+            stream.write(f"CPU profile of {len(self.profiles)} threads\n")
+        for sort in ('cumulative', 'tottime'):
+            stream.write(f"\nTop {limit} functions by {sort} time:\n")
+            stats.sort_stats(sort).print_stats(limit)
+            stream.write(f"\nTop {limit} {PACKAGE_PATTERN} functions by {sort} time:\n")
+            stats.sort_stats(sort).print_stats(PACKAGE_PATTERN, limit)
+
+        return stream.getvalue()
+
+    def dump(self, path):
+        """Save the combined stats to a file readable by pstats."""
+
+        self.stats()[0].dump_stats(path)
+
+
+class MemoryProfiler(object):
+    """Trace allocations with tracemalloc."""
+
+    def __init__(self, frames=10):
+        self.frames = frames
+        self.snapshot = None
+
+    def start(self):
+        tracemalloc.start(self.frames)
+
+    def stop(self):
+        self.snapshot = tracemalloc.take_snapshot()
+        self.current, self.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def report(self, limit=30):
+        stream = io.StringIO()
+
+        stream.write(f"Traced memory: {self.current / 1e6:.1f} MB at exit, "
+                     f"{self.peak / 1e6:.1f} MB peak\n")
+
+        snapshot = self.snapshot.filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+        package_snapshot = snapshot.filter_traces(
+            [tracemalloc.Filter(True, f"*{PACKAGE_PATTERN}*")])
+
+        for title, snap in ((f"Top {limit} allocation sites", snapshot),
+                            (f"Top {limit} {PACKAGE_PATTERN} allocation sites", package_snapshot)):
+            stream.write(f"\n{title}:\n")
+            for stat in snap.statistics('lineno')[:limit]:
+                stream.write(f"{stat}\n")
+
+        return stream.getvalue()
+
+    def dump(self, path):
+        """Save the tracemalloc snapshot to a file."""
+
+        self.snapshot.dump(path)
+
+
+def _finish(profiler, output):
+    profiler.stop()
+
+    if output == "-":
+        sys.stderr.write(profiler.report())
+    else:
+        with open(output, 'w') as report_file:
+            report_file.write(profiler.report())
+        profiler.dump(f"{output}.data")
+
+
+def start(kind, output="-"):
+    """Profile the rest of the run and write a report on exit.
+
+    Args:
+        kind: 'cpu' for cProfile or 'memory' for tracemalloc.
+        output: A file to write the report to, or '-' for stderr. When
+                writing to a file, the raw profile is also saved next to it
+                with a '.data' suffix (pstats stats for 'cpu', a
+                tracemalloc snapshot for 'memory').
+    Returns:
+        The CPUProfiler or MemoryProfiler.
+    """
+
+    if kind == 'cpu':
+        profiler = CPUProfiler()
+    elif kind == 'memory':
+        profiler = MemoryProfiler()
+    else:
+        raise ValueError(f"Unknown profiler {kind}, use one of {list(PROFILERS)}.")
+
+    profiler.start()
+    atexit.register(_finish, profiler, output)
+
+    return profiler
+
+
+def add_arguments(parser):
+    """Add the --stats, --profile and --profile_output options to a parser."""
+
+    parser.add_argument("--stats", type=str, default=None,
+                        help="Write request and processing stage metrics as JSON to this file ('-' for stderr) on exit.")
+    parser.add_argument("--profile", type=str, default=None,
+                        choices=PROFILERS,
+                        help="Profile the run and report the hottest functions (cpu) or top allocation sites (memory) on exit.")
+    parser.add_argument("--profile_output", type=str, default="-",
+                        help="File to write the profile report to. Default is stderr.")
+
+
+def setup(args):
+    """Start writing stats and profiling as requested by `add_arguments` options."""
+
+    if args.stats:
+        metrics.metrics.enable()
+        atexit.register(metrics.write_stats, args.stats)
+
+    if args.profile:
+        start(args.profile, args.profile_output)
@@ -0,0 +1,276 @@
+"""Run commands in a long-lived server process.
+
+A server listens on a Unix socket or a localhost TCP port and runs each
+command it receives with a callback, streaming the command's output back to
+the client as it is written. Keeping one process alive avoids paying for
+interpreter startup, imports, authentication and new connections on every
+command, and lets responses be cached across commands (see ndasynapse.cache.LRUCache
+and ndasynapse.nda.response_cache).
+
+Addresses are either 'unix:<path>' for a Unix socket or '[host:]port' for
+TCP. TCP servers bind to 127.0.0.1 unless a host is given, and refuse hosts
+that are not loopback addresses.
+
+Commands run with the server's credentials, so only the user running the
+server may send them. A Unix socket is created readable and writable by
+that user only. Any local user can connect to a TCP port, so a TCP server
+writes a random token to a file only that user can read (see token_path)
+and runs only commands sent with the token.
+
+The client sends one JSON line, {"argv": [...], "cwd": ..., "token": ...},
+where cwd is the client's working directory for resolving relative paths. The server replies with
+frames of a one-byte type and a four-byte length followed by the payload:
+'o' for output, 'e' for error messages and a final 'x' with the exit status.
+
+"""
+
+import hmac
+import io
+import ipaddress
+import json
+import logging
+import os
+import secrets
+import socket
+import socketserver
+import struct
+import sys
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+OUTPUT = b"o"
+ERROR = b"e"
+EXIT = b"x"
+
+_FRAME_HEADER = struct.Struct("!cI")
+
+
+def parse_address(address):
+    """Get the socket family and address for a server address string."""
+
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:"):]
+
+    host, _, port = address.rpartition(":")
+    return socket.AF_INET, (host or "127.0.0.1", int(port))
+
+
+def token_path(port):
+    """Get the file the token of the TCP server on a port is kept in."""
+
+    return os.path.join(os.path.expanduser("~"), f".ndasynapse-server-{port}.token")
+
+
+def _is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+def _write_token(path):
+    token = secrets.token_hex(32)
+
+    if os.path.exists(path):
+        os.remove(path)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as token_file:
+        token_file.write(token)
+
+    return token
+
+
+def _read_token(path):
+    try:
+        with open(path) as token_file:
+            return token_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+
+def _send(wfile, kind, payload):
+    wfile.write(_FRAME_HEADER.pack(kind, len(payload)) + payload)
+    wfile.flush()
+
+
+def _receive(rfile):
+    header = rfile.read(_FRAME_HEADER.size)
+    if len(header) < _FRAME_HEADER.size:
+        return None, None
+    kind, length = _FRAME_HEADER.unpack(header)
+    return kind, rfile.read(length)
+
+
+class _FrameWriter(io.RawIOBase):
+    """A binary stream that sends everything written to it as frames of one type."""
+
+    def __init__(self, wfile, kind):
+        self.wfile = wfile
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        if len(b):
+            _send(self.wfile, self.kind, bytes(b))
+        return len(b)
+
+
+def _text_stream(wfile, kind):
+    """Make a text stream, with a binary `buffer`, that writes frames."""
+
+    return io.TextIOWrapper(io.BufferedWriter(_FrameWriter(wfile, kind)),
+                            encoding="utf-8", write_through=True)
+
+
+class _CommandHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode("utf-8"))
+        output = _text_stream(self.wfile, OUTPUT)
+        errors = _text_stream(self.wfile, ERROR)
+
+        token = request.get('token')
+        if self.server.token is not None and \
+                not (isinstance(token, str) and hmac.compare_digest(token, self.server.token)):
+            logger.warning("Refused a command without the server token.")
+            errors.write("The server refused the command: missing or wrong server token.\n")
+            errors.flush()
+            _send(self.wfile, EXIT, b"1")
+            return
+
+        try:
+            status = self.server.command(request['argv'], output, errors,
+                                         request.get('cwd'))
+        except SystemExit as e:
+            status = e.code
+        except Exception as e:
+            logger.exception(f"Command {request['argv']} failed.")
+            errors.write(f"{type(e).__name__}: {e}\n")
+            status = 1
+
+        if status is not None and not isinstance(status, int):
+            errors.write(f"{status}\n")
+            status = 1
+
+        output.flush()
+        errors.flush()
+        _send(self.wfile, EXIT, str(status or 0).encode("utf-8"))
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ThreadingTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address, command):
+    """Make a server that runs commands.
+
+    Args:
+        address: 'unix:<path>' or '[host:]port'.
+        command: A function taking a list of arguments, a text output
+                 stream, a text error stream and the client's working
+                 directory, and returning an exit status. It is called in
+                 a new thread for each client.
+    Returns:
+        A socketserver server. Call its serve_forever method to start it.
+        A TCP server's token is in its `token` attribute and in the file
+        at token_path(port).
+    Raises:
+        ValueError: If a TCP host is not a loopback address.
+    """
+
+    family, server_address = parse_address(address)
+
+    if family == socket.AF_UNIX:
+        if os.path.exists(server_address):
+            os.remove(server_address)
+        # Create the socket without access for other users, rather than
+        # restricting it once it is already listening
+        umask = os.umask(0o077)
+        try:
+            server = _ThreadingUnixServer(server_address, _CommandHandler)
+        finally:
+            os.umask(umask)
+        server.token = None
+    else:
+        host = server_address[0]
+        if not _is_loopback(host):
+            raise ValueError(f"Refusing to serve on {host}, which is not a loopback address.")
+        server = _ThreadingTCPServer(server_address, _CommandHandler)
+        server.token = _write_token(token_path(server.server_address[1]))
+
+    server.command = command
+    return server
+
+
+def serve(address, command):
+    """Run commands from clients until interrupted. See make_server."""
+
+    server = make_server(address, command)
+    logger.info(f"Serving on {address}.")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if server.address_family == socket.AF_UNIX:
+            os.remove(server.server_address)
+        else:
+            os.remove(token_path(server.server_address[1]))
+
+
+def request(address, argv, stdout=None, stderr=None, cwd=None):
+    """Run a command on a server, writing its output as it arrives.
+
+    Args:
+        address: The server address; see make_server.
+        argv: A list of command arguments.
+        stdout: A binary stream for the output. Defaults to standard output.
+        stderr: A binary stream for errors. Defaults to standard error.
+        cwd: The directory relative paths in the command are in. Defaults
+             to the current working directory.
+    Returns:
+        The exit status of the command.
+    """
+
+    if stdout is None:
+        stdout = sys.stdout.buffer
+    if stderr is None:
+        stderr = sys.stderr.buffer
+
+    family, server_address = parse_address(address)
+
+    message = {'argv': list(argv), 'cwd': cwd or os.getcwd()}
+    if family != socket.AF_UNIX:
+        message['token'] = _read_token(token_path(server_address[1]))
+
+    with socket.socket(family, socket.SOCK_STREAM) as sock:
+        sock.connect(server_address)
+        rfile = sock.makefile('rb')
+        wfile = sock.makefile('wb')
+
+        wfile.write(json.dumps(message).encode("utf-8") + b"\n")
+        wfile.flush()
+
+        while True:
+            kind, payload = _receive(rfile)
+            if kind is None:
+                raise ConnectionError(f"Server {address} closed the connection before the command finished.")
+            elif kind == OUTPUT:
+                stdout.write(payload)
+                stdout.flush()
+            elif kind == ERROR:
+                stderr.write(payload)
+                stderr.flush()
+            elif kind == EXIT:
+                return int(payload)
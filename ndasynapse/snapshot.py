@@ -0,0 +1,210 @@
+"""Save and reload NDA collection data as columnar snapshots.
+
+A snapshot is a directory with one Arrow IPC (or Parquet) file per table
+plus an `index.json` file describing the tables. Arrow IPC tables can be
+memory-mapped on reload, so they are available without querying NDA again.
+
+Requires the optional `pyarrow` package.
+
+"""
+
+import datetime
+import json
+import logging
+import os
+import sys
+
+import pandas
+
+logging.basicConfig()
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+SNAPSHOT_VERSION = 1
+INDEX_FILE = "index.json"
+FORMATS = {'arrow': '.arrow', 'parquet': '.parquet'}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Snapshots require the pyarrow package. Install it with 'pip install pyarrow'.")
+
+    return pyarrow
+
+
+def collection_tables(collections):
+    """Get the submission data of NDA collections as data frames.
+
+    Args:
+        collections: A list of ndasynapse.nda.NDACollection objects.
+    Returns:
+        A dictionary of data frames: 'submissions' with one row per
+        submission, 'submission_files' with one row per submission file,
+        and 'guids' with one row per submission and GUID.
+    """
+
+    submissions = []
+    submission_files = []
+    guids = []
+
+    for collection in collections:
+        for submission in collection.submissions:
+            submissions.append(submission.processed_submission)
+            submission_files.append(submission.submission_files['processed_files'])
+            guids.extend(dict(collection_id=collection.collection_id,
+                              submission_id=submission.submission_id,
+                              guid=str(guid))
+                         for guid in sorted(submission.guids, key=str))
+
+    def concat(data):
+        if not data:
+            return pandas.DataFrame()
+        return pandas.concat(data, axis=0, ignore_index=True, sort=False)
+
+    return {'submissions': concat(submissions),
+            'submission_files': concat(submission_files),
+            'guids': pandas.DataFrame(guids, columns=['collection_id',
+                                                      'submission_id',
+                                                      'guid'])}
+
+
+def write_snapshot(path, collections=(), frames=None, file_format="arrow"):
+    """Write a snapshot of NDA collections and processed data frames.
+
+    Args:
+        path: Directory to write the snapshot to. It is created if needed.
+        collections: A list of ndasynapse.nda.NDACollection objects.
+        frames: A dictionary of other data frames to save, keyed by table
+                name (for example, processed GUID data by manifest type).
+        file_format: 'arrow' for Arrow IPC files, which can be memory-mapped,
+                     or 'parquet'.
+    Returns:
+        The snapshot index as a dictionary.
+    """
+
+    pyarrow = _import_pyarrow()
+
+    if file_format not in FORMATS:
+        raise ValueError(f"Unknown snapshot format {file_format}, use one of {list(FORMATS)}.")
+
+    tables = collection_tables(collections) if collections else {}
+    tables.update(frames or {})
+
+    os.makedirs(path, exist_ok=True)
+
+    index = {'version': SNAPSHOT_VERSION,
+             'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+             'format': file_format,
+             'collection_ids': [collection.collection_id for collection in collections],
+             'tables': {}}
+
+    for name, df in tables.items():
+        file_name = f"{name}{FORMATS[file_format]}"
+        table = pyarrow.Table.from_pandas(df, preserve_index=False)
+
+        if file_format == "arrow":
+            with pyarrow.OSFile(os.path.join(path, file_name), 'wb') as sink:
+                with pyarrow.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+        else:
+            pyarrow.parquet.write_table(table, os.path.join(path, file_name))
+
+        index['tables'][name] = {'file': file_name,
+                                 'rows': table.num_rows,
+                                 'columns': table.column_names}
+        logger.debug(f"Wrote {table.num_rows} rows to table {name}.")
+
+    with open(os.path.join(path, INDEX_FILE), 'w') as index_file:
+        json.dump(index, index_file, indent=2)
+
+    logger.info(f"Wrote snapshot with {len(tables)} tables to {path}.")
+
+    return index
+
+
+def read_snapshot_index(path):
+    """Read the index of a snapshot.
+
+    Raises:
+        ValueError: If the snapshot was written with another snapshot version.
+    """
+
+    with open(os.path.join(path, INDEX_FILE)) as index_file:
+        index = json.load(index_file)
+
+    if index.get('version') != SNAPSHOT_VERSION:
+        raise ValueError(f"Snapshot {path} has version {index.get('version')}, expected {SNAPSHOT_VERSION}.")
+
+    return index
+
+
+def read_snapshot(path, tables=None, memory_map=True, as_arrow=False):
+    """Read tables from a snapshot.
+
+    Args:
+        path: Snapshot directory written by `write_snapshot`.
+        tables: A list of table names to read. If None, reads all tables.
+        memory_map: Memory-map Arrow IPC files instead of reading them.
+        as_arrow: Return pyarrow Tables instead of pandas data frames. Arrow
+                  tables read from a memory map are not copied into memory.
+    Returns:
+        A dictionary of tables keyed by table name.
+    """
+
+    pyarrow = _import_pyarrow()
+
+    index = read_snapshot_index(path)
+
+    if tables is None:
+        tables = list(index['tables'])
+
+    result = {}
+
+    for name in tables:
+        try:
+            file_path = os.path.join(path, index['tables'][name]['file'])
+        except KeyError:
+            raise KeyError(f"No table {name} in snapshot {path}.")
+
+        if index['format'] == "arrow":
+            source = pyarrow.memory_map(file_path) if memory_map \
+                else pyarrow.OSFile(file_path)
+            table = pyarrow.ipc.open_file(source).read_all()
+        else:
+            table = pyarrow.parquet.read_table(file_path, memory_map=memory_map)
+
+        result[name] = table if as_arrow else table.to_pandas()
+
+    return result
+
+
+def read_snapshot_table(path, table, **kwargs):
+    """Read a single table from a snapshot. See `read_snapshot`."""
+
+    return read_snapshot(path, tables=[table], **kwargs)[table]
+
+
+def read_table(path, table):
+    """Read a table from a snapshot directory, or from a CSV file.
+
+    Lets scripts that read CSV output of query-nda or manifest_guid_data.py
+    start from a snapshot instead.
+
+    Args:
+        path: A snapshot directory, a CSV file, or '-' for CSV on stdin.
+        table: The snapshot table to read if path is a directory.
+    Returns:
+        A pandas data frame.
+    """
+
+    if os.path.isdir(path):
+        return read_snapshot_table(path, table)
+
+    if path == "-":
+        path = sys.stdin
+
+    return pandas.read_csv(path)
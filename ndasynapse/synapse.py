@@ -1,12 +1,18 @@
 import os
 import json
+import time
 import uuid
 import logging
 import base64
+import hashlib
+import threading
+import multiprocessing.dummy
 
 import pandas
 import synapseclient
 
+from .metrics import metrics, timed
+
 pandas.options.display.max_rows = None
 pandas.options.display.max_columns = None
 pandas.options.display.max_colwidth = 1000
@@ -21,28 +27,370 @@ logger.setLevel(logging.DEBUG)
 # Synapse configuration
 dry_run = False
 
+
+def _call(metric_name, func, *args, **kwargs):
+    """Call a Synapse client method, recording its request metrics under a name."""
+
+    with metrics.request(metric_name):
+        return func(*args, **kwargs)
+
 content_type_dict = {'.gz': 'application/x-gzip',
                      '.bam': 'application/octet-stream',
                      '.zip': 'application/zip'}
 
 
-def check_existing_by_datasetid(syn, datasetids, file_view_id):
+def _load_datasetid_cache(cache_file, file_view_id):
+    """Load a saved map of file IDs to datasetids for a file view."""
+
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+        except ValueError:
+            logger.warning("Ignoring unreadable datasetid cache %s" % (cache_file, ))
+            cache = {}
+        if cache.get('file_view_id') == file_view_id:
+            return cache
+        if cache:
+            logger.warning("Ignoring datasetid cache %s for another file view" % (cache_file, ))
+
+    return {'file_view_id': file_view_id, 'watermark': None, 'datasetids': {}}
+
+
+def check_existing_by_datasetid(syn, datasetids, file_view_id, cache_file=None):
     """Check a file view that has a 'datasetid' column to see which datasetids exist.
 
+    If a cache file is given, the datasetid of each file is saved in it with
+    the latest modifiedOn time seen, and later calls only query files
+    modified since then. Files deleted from the view are not noticed until
+    the cache file is removed.
+
     """
 
-    res = syn.tableQuery('select id,datasetid from %s' % (file_view_id, ))
-    d = res.asDataFrame()
+    if cache_file is None:
+        res = _call("synapse.table_query", syn.tableQuery,
+                    'select id,datasetid from %s' % (file_view_id, ))
+        d = res.asDataFrame()
+
+        existing_datasetids = set(d.datasetid.tolist())
+    else:
+        cache = _load_datasetid_cache(cache_file, file_view_id)
+
+        query = 'select id,datasetid,modifiedOn from %s' % (file_view_id, )
+        if cache['watermark'] is not None:
+            # Files modified at the watermark time may not all have been seen
+            query += ' where modifiedOn >= %s' % (cache['watermark'], )
+
+        d = _call("synapse.table_query", syn.tableQuery, query).asDataFrame()
+
+        for (fileId, datasetid) in zip(d.id.tolist(), d.datasetid.tolist()):
+            cache['datasetids'][fileId] = None if pandas.isnull(datasetid) else datasetid
+
+        if d.shape[0] > 0:
+            cache['watermark'] = max(int(d.modifiedOn.max()), cache['watermark'] or 0)
+
+        logger.info("Updated datasetids of %s files from %s" % (d.shape[0], file_view_id))
+
+        tmp_cache_file = f"{cache_file}.tmp"
+        with open(tmp_cache_file, 'w') as f:
+            json.dump(cache, f, default=lambda x: x.item())
+        os.replace(tmp_cache_file, cache_file)
+
+        existing_datasetids = set(x for x in cache['datasetids'].values() if x is not None)
 
-    existing_datasetids = set(d.datasetid.tolist())
     given_datasetids = set(datasetids)
 
     return {'exists': given_datasetids.intersection(existing_datasetids),
             'not_exists': given_datasetids.difference(existing_datasetids)}
 
 
-def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose=False):
-    """Create a list of Synapse file handles (S3FileHandles) to link to."""
+MD5_INDEX_QUERY = 'select id,currentVersion,parentId,dataFileHandleId,dataFileMD5Hex from %s'
+FILE_VIEW_VERSION_QUERY = 'select count(*),max(modifiedOn) from %s'
+
+
+def file_view_version(syn, file_view_id):
+    """Get the number of files in a file view and when the latest one was modified.
+
+    This changes when files are added, deleted, moved or updated, so it can
+    tell whether something saved from a file view is stale.
+
+    Returns:
+        A list of the count and latest modifiedOn, as strings.
+    """
+
+    res = _call("synapse.table_query", syn.tableQuery,
+                FILE_VIEW_VERSION_QUERY % (file_view_id, ))
+    return [str(x) for x in res.asDataFrame().iloc[0].tolist()]
+
+
+@timed("synapse.build_md5_index")
+def build_md5_index(syn, file_view_id, index_file=None, refresh=False):
+    """Build an index of the files in a file view by md5 with one query.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        file_view_id: Synapse ID of a file view.
+        index_file: Optional path of a JSON file to save the index to. If it
+                    exists, is for the same file view and the file view has
+                    not changed since (see `file_view_version`), the index is
+                    loaded from it instead of querying Synapse.
+        refresh: Query Synapse even if index_file exists.
+    Returns:
+        A dictionary keyed by md5 of lists of entities, like the 'results'
+        of the /entity/md5 REST call plus their 'dataFileHandleId'.
+    """
+
+    version = None
+    if index_file is not None:
+        version = file_view_version(syn, file_view_id)
+
+    if index_file is not None and not refresh and os.path.exists(index_file):
+        with open(index_file) as f:
+            saved = json.load(f)
+        if saved.get('file_view_id') != file_view_id:
+            logger.info("Ignoring md5 index %s for another file view" % (index_file, ))
+        elif saved.get('version') != version:
+            logger.info("File view %s changed since the md5 index %s was saved" %
+                        (file_view_id, index_file))
+        else:
+            logger.info("Loaded md5 index for %s from %s" % (file_view_id, index_file))
+            return saved['index']
+
+    res = _call("synapse.table_query", syn.tableQuery, MD5_INDEX_QUERY % (file_view_id, ))
+    d = res.asDataFrame()
+
+    index = {}
+    for row in d.itertuples(index=False):
+        if pandas.isnull(row.dataFileMD5Hex):
+            continue
+        index.setdefault(row.dataFileMD5Hex, []).append(
+            {'id': row.id,
+             'versionNumber': int(row.currentVersion),
+             'parentId': row.parentId,
+             'dataFileHandleId': str(row.dataFileHandleId)})
+
+    logger.info("Indexed %s md5s from %s" % (len(index), file_view_id))
+
+    if index_file is not None:
+        # The version is from before the query, so changes made during it
+        # make the saved index stale.
+        tmp_index_file = f"{index_file}.tmp"
+        with open(tmp_index_file, 'w') as f:
+            json.dump({'file_view_id': file_view_id, 'version': version,
+                       'index': index}, f)
+        os.replace(tmp_index_file, index_file)
+
+    return index
+
+
+def entities_by_md5(syn, contentMd5, md5_index=None):
+    """Get the entities with an md5, from an md5 index if possible.
+
+    Falls back to the /entity/md5 REST call for md5s not in the index.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        contentMd5: An md5 checksum.
+        md5_index: An index from `build_md5_index`, or None.
+    Returns:
+        A list of dictionaries with at least 'id' and 'versionNumber'.
+    """
+
+    if md5_index is not None and contentMd5 in md5_index:
+        return md5_index[contentMd5]
+
+    return _call("synapse.entity_md5", syn.restGET,
+                 "/entity/md5/%s" % (contentMd5, ))['results']
+
+
+# Maximum number of file handles in one /fileHandle/batch request
+FILE_HANDLE_BATCH_SIZE = 100
+
+def get_filehandles_batch(syn, associations, cache=None):
+    """Get file handles of entities with the batch file handle API.
+
+    Requests are chunked to FILE_HANDLE_BATCH_SIZE file handles, and file
+    handles already in the cache are not requested again.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        associations: A list of dictionaries with a 'fileHandleId' and the
+                      'associateObjectId' (Synapse ID) of the File entity.
+        cache: A dictionary of file handles keyed by file handle ID, shared
+               by the calls of one run. Retrieved file handles are added to it.
+    Returns:
+        A dictionary of file handles keyed by file handle ID (as a string).
+        File handles that could not be retrieved are logged and left out.
+    """
+
+    if cache is None:
+        cache = {}
+
+    requested = {}
+    for association in associations:
+        fileHandleId = str(association['fileHandleId'])
+        if fileHandleId not in cache:
+            requested[fileHandleId] = association['associateObjectId']
+
+    requested = list(requested.items())
+
+    for start in range(0, len(requested), FILE_HANDLE_BATCH_SIZE):
+        chunk = requested[start:start + FILE_HANDLE_BATCH_SIZE]
+        body = {'requestedFiles': [{'fileHandleId': fileHandleId,
+                                    'associateObjectId': entityId,
+                                    'associateObjectType': 'FileEntity'}
+                                   for (fileHandleId, entityId) in chunk],
+                'includeFileHandles': True,
+                'includePreSignedURLs': False,
+                'includePreviewPreSignedURLs': False}
+
+        res = _call("synapse.filehandle_batch", syn.restPOST,
+                    '/fileHandle/batch', json.dumps(body),
+                    endpoint=syn.fileHandleEndpoint)
+
+        for requested_file in res['requestedFiles']:
+            if requested_file.get('failureCode'):
+                logger.warning("Could not get file handle %s: %s" %
+                               (requested_file['fileHandleId'],
+                                requested_file['failureCode']))
+                continue
+            cache[str(requested_file['fileHandleId'])] = requested_file['fileHandle']
+
+    return {str(x['fileHandleId']): cache[str(x['fileHandleId'])]
+            for x in associations if str(x['fileHandleId']) in cache}
+
+
+def _find_entity_filehandle(syn, contentMd5, verbose=False, md5_index=None,
+                            cache=None):
+    """Find the first entity with an md5, and its file handle if it is not in the index.
+
+    Returns:
+        A tuple of the entity (or None) and its file handle (or None if it
+        should be retrieved with `get_filehandles_batch`).
+    """
+
+    if cache is None:
+        cache = {}
+
+    # Check if it exists in Synapse
+    res = entities_by_md5(syn, contentMd5, md5_index=md5_index)
+
+    if verbose:
+        logger.info("Checked for md5 %s" % contentMd5)
+
+    # res = filter(lambda x: x['benefactorId'] == synapse_data_folder_id, res)
+
+    if len(res) == 0:
+        return (None, None)
+
+    # Only the first entity's file handle is used
+    entity = res[0]
+
+    if entity.get('dataFileHandleId') is not None:
+        return (entity, cache.get(str(entity['dataFileHandleId'])))
+
+    fhs = _call("synapse.entity_filehandles", syn.restGET,
+                "/entity/%(id)s/version/%(versionNumber)s/filehandles" % entity)
+    fileHandle = fhs['list'][0]
+    cache[str(fileHandle['id'])] = fileHandle
+
+    if verbose:
+        logger.info("Got filehandle for %s" % fileHandle['id'])
+
+    return (entity, fileHandle)
+
+
+def get_existing_filehandle(syn, contentMd5, verbose=False, md5_index=None):
+    """Get the file handle of the first Synapse entity with an md5.
+
+    Returns:
+        The file handle as a dictionary, or None if no entity has the md5.
+    """
+
+    return resolve_existing_filehandles(syn, [contentMd5], parallel=1,
+                                        verbose=verbose,
+                                        md5_index=md5_index)[contentMd5]
+
+
+@timed("synapse.resolve_existing_filehandles")
+def resolve_existing_filehandles(syn, md5s, parallel=4, verbose=False,
+                                 progress_interval=1000, md5_index=None,
+                                 cache=None):
+    """Look up existing Synapse file handles for md5s in parallel threads.
+
+    Each distinct md5 is looked up once. File handles of entities found in
+    the md5 index are retrieved together with `get_filehandles_batch`.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        md5s: A list of md5 checksums.
+        parallel: Number of md5s to look up at the same time.
+        verbose: Log each lookup.
+        progress_interval: Log progress and throughput after this many md5s.
+        md5_index: An index from `build_md5_index`. md5s not in it are
+                   looked up with the REST API.
+        cache: A dictionary of file handles keyed by file handle ID to reuse
+               across calls. If None, a new one is used for this call.
+    Returns:
+        A dictionary of file handles (or None if not in Synapse) keyed by md5.
+    """
+
+    if cache is None:
+        cache = {}
+
+    unique_md5s = list(dict.fromkeys(md5s))
+    existing = {}
+    batch_entities = {}
+
+    worker = lambda md5: (md5, _find_entity_filehandle(syn, md5, verbose=verbose,
+                                                       md5_index=md5_index,
+                                                       cache=cache))
+
+    start = time.time()
+    pool = multiprocessing.dummy.Pool(parallel)
+
+    try:
+        for n, (md5, (entity, fileHandle)) in enumerate(pool.imap_unordered(worker, unique_md5s), 1):
+            existing[md5] = fileHandle
+            if entity is not None and fileHandle is None:
+                batch_entities[md5] = entity
+
+            if n % progress_interval == 0 or n == len(unique_md5s):
+                elapsed = time.time() - start
+                logger.info("Resolved %s/%s md5s (%s found) in %.1fs, %.1f md5s/s" %
+                            (n, len(unique_md5s),
+                             sum(fh is not None for fh in existing.values()) + len(batch_entities),
+                             elapsed, n / elapsed if elapsed else 0))
+    finally:
+        pool.terminate()
+
+    if batch_entities:
+        fileHandles = get_filehandles_batch(
+            syn, [{'fileHandleId': entity['dataFileHandleId'],
+                   'associateObjectId': entity['id']}
+                  for entity in batch_entities.values()],
+            cache=cache)
+
+        for md5, entity in batch_entities.items():
+            existing[md5] = fileHandles.get(str(entity['dataFileHandleId']))
+
+    return existing
+
+
+@timed("synapse.create_synapse_filehandles")
+def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose=False,
+                               parallel=4, md5_index=None):
+    """Create a list of Synapse file handles (S3FileHandles) to link to.
+
+    Existing file handles are looked up by md5 in parallel threads, using
+    an md5 index from `build_md5_index` if given; see
+    `resolve_existing_filehandles`. The list is in the order of the manifest.
+
+    """
+
+    existing = resolve_existing_filehandles(syn, metadata_manifest['md5'].tolist(),
+                                            parallel=parallel, verbose=verbose,
+                                            md5_index=md5_index)
 
     fh_list = []
 
@@ -57,20 +405,8 @@ def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose
         contentSize = x['size']
         contentMd5 = x['md5']
 
-        # Check if it exists in Synapse
-        res = syn.restGET("/entity/md5/%s" % (contentMd5, ))['results']
-
-        if verbose:
-            logger.info("Checked for md5 %s" % contentMd5)
-
-        # res = filter(lambda x: x['benefactorId'] == synapse_data_folder_id, res)
-
-        if len(res) > 0:
-            fhs = [syn.restGET("/entity/%(id)s/version/%(versionNumber)s/filehandles" % er) for er in res]
-            fileHandle = syn._getFileHandle(fhs[0]['list'][0]['id'])
-
-            if verbose:
-                logger.info("Got filehandle for %s" % fhs[0]['list'][0]['id'])
+        if existing[contentMd5] is not None:
+            fileHandle = dict(existing[contentMd5])
 
         else:
             contentType = content_type_dict.get(os.path.splitext(x['data_file'])[-1],
@@ -92,24 +428,33 @@ def create_synapse_filehandles(syn, metadata_manifest, storage_location, verbose
 
     return fh_list
 
-def get_filehandles_by_md5(syn, md5):
-    res = syn.restGET("/entity/md5/%s" % md5)
+def get_filehandles_by_md5(syn, md5, md5_index=None):
+    res = entities_by_md5(syn, md5, md5_index=md5_index)
+
+    # File handles of entities from the md5 index are retrieved in batches
+    fileHandles = get_filehandles_batch(
+        syn, [{'fileHandleId': er['dataFileHandleId'], 'associateObjectId': er['id']}
+              for er in res if er.get('dataFileHandleId') is not None])
 
-    fhs = [syn.restGET("/entity/%(id)s/version/%(versionNumber)s/filehandles" % er) for er in res]
+    fhs = [{'list': [fileHandles[str(er['dataFileHandleId'])]]}
+           if str(er.get('dataFileHandleId')) in fileHandles
+           else _call("synapse.entity_filehandles", syn.restGET,
+                      "/entity/%(id)s/version/%(versionNumber)s/filehandles" % er)
+           for er in res]
 
     return fhs
 
 
-def entity_by_md5(syn, contentMd5, parentId=None, cmp=None):
+def entity_by_md5(syn, contentMd5, parentId=None, cmp=None, md5_index=None):
     """Gets the first entity in a list of entities identified by md5.
 
-    Optionally takes a comparison function to pass to sorted
-    and a parent id for filtering.
+    Optionally takes a comparison function to pass to sorted,
+    a parent id for filtering, and an md5 index from `build_md5_index`.
 
     """
 
     # Check if it exists in Synapse
-    res = syn.restGET("/entity/md5/%s" % (contentMd5, ))['results']
+    res = entities_by_md5(syn, contentMd5, md5_index=md5_index)
 
     if cmp:
         res = sorted(res, cmp=cmp)
@@ -118,15 +463,23 @@ def entity_by_md5(syn, contentMd5, parentId=None, cmp=None):
         res = filter(lambda x: x['parentId'] == parentId, res)
 
     try:
-        entity = syn.get(res[0]['id'], version=res[0]['versionNumber'])
+        entity = _call("synapse.get_entity", syn.get, res[0]['id'],
+                       version=res[0]['versionNumber'])
     except KeyError:
         entity = None
 
     return entity
 
 
+# Namespace UUIDs already retrieved, keyed by project ID
+_namespaces = {}
+
+
 def get_namespace(syn, projectId):
-    return syn.getAnnotations(projectId)['namespace_uuid'][0]
+    if projectId not in _namespaces:
+        _namespaces[projectId] = _call("synapse.get_annotations", syn.getAnnotations,
+                                       projectId)['namespace_uuid'][0]
+    return _namespaces[projectId]
 
 
 def uuid2slug(uuid):
@@ -136,42 +489,453 @@ def uuid2slug(uuid):
 def slug2uuid(slug):
     return uuid.UUID(bytes=base64.urlsafe_b64decode((slug + '==').replace('_', '/')))
 
-def store(syn, synapse_manifest, filehandles, verbose=False, ignore_errors=False):
 
-    f_list = []
+def slugify_paths(paths, namespace):
+    """Get the slug of the name-based (version 3) UUID of each path in a namespace.
+
+    This gives the same result as `uuid2slug(uuid.uuid3(namespace, path))`
+    for each path, computed directly from the md5 digest.
 
-    for (row, file_handle) in zip(synapse_manifest.iterrows(), filehandles):
+    Args:
+        paths: A list of paths (for example, the data_file column of a manifest).
+        namespace: A namespace UUID, as a uuid.UUID or a string.
+    Returns:
+        A list of slugs in the order of paths.
+    """
 
-        i, x = row
-        a = x.to_dict()
+    if not isinstance(namespace, uuid.UUID):
+        namespace = uuid.UUID(str(namespace))
 
-        if not file_handle.get('id'):
-            try:
-                stored_file_handle = syn.restPOST('/externalFileHandle/s3',
-                                                  json.dumps(file_handle),
-                                                  endpoint=syn.fileHandleEndpoint)
-                a['dataFileHandleId'] = stored_file_handle['id']
-            except Exception as e:
-                logger.error("File handle: %s" % (file_handle,))
-                if ignore_errors:
-                    continue
-                else:
-                    raise e
-        else:
-            if file_handle['id'] != a['dataFileHandleId']:
-                if ignore_errors:
-                    logger.error("Not equal: %s != %s" % (file_handle['id'],
+    namespace_bytes = namespace.bytes
+    md5 = hashlib.md5
+    b64encode = base64.urlsafe_b64encode
+
+    slugs = []
+
+    for path in paths:
+        digest = bytearray(md5(namespace_bytes + path.encode('utf-8')).digest())
+        # Set the UUID version (3) and variant (RFC 4122) bits
+        digest[6] = (digest[6] & 0x0f) | 0x30
+        digest[8] = (digest[8] & 0x3f) | 0x80
+        slugs.append(b64encode(bytes(digest)).decode('ascii').rstrip("="))
+
+    return slugs
+
+# Manifest columns that are filled in from Synapse, and so can change
+# between runs for the same row
+JOURNAL_VOLATILE_COLUMNS = ('dataFileHandleId', )
+
+
+def row_fingerprint(row):
+    """Get a stable hash of a Synapse manifest row.
+
+    The hash covers the row's properties and annotations, such as parentId,
+    name, md5 and data_file, but not the file handle ID looked up for it,
+    which a rerun finds for rows whose entities were already stored.
+    """
+
+    data = json.dumps({key: value for key, value in row.items()
+                       if key not in JOURNAL_VOLATILE_COLUMNS},
+                      sort_keys=True, default=str)
+
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+class StoreJournal(object):
+    """A write-ahead journal of the rows stored by `store`, in a JSON lines file.
+
+    Each line records the file handle ID created for a row, or the
+    entity stored for it, keyed by `row_fingerprint`. Passing the same
+    journal to a rerun of `store` skips completed rows and reuses file
+    handles that were already created.
+
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file_handle_ids = {}
+        self.entities = {}
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A partially written last line from a crash
+                        logger.warning("Skipping unreadable journal line in %s" % (path, ))
+                        continue
+                    self._load(record)
+
+            logger.info("Journal %s has %s completed rows" % (path, len(self.entities)))
+
+        self._file = open(path, 'a')
+
+    def _load(self, record):
+        if 'dataFileHandleId' in record:
+            self.file_handle_ids[record['fingerprint']] = record['dataFileHandleId']
+        if 'entityId' in record:
+            self.entities[record['fingerprint']] = record
+
+    def _write(self, record):
+        with self._lock:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._load(record)
+
+    def record_file_handle(self, fingerprint, file_handle_id):
+        self._write({'fingerprint': fingerprint,
+                     'dataFileHandleId': file_handle_id})
+
+    def record_entity(self, fingerprint, entity):
+        self._write({'fingerprint': fingerprint,
+                     'dataFileHandleId': entity.dataFileHandleId,
+                     'entityId': entity.id,
+                     'versionNumber': entity.get('versionNumber')})
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def store_row(syn, row, file_handle, verbose=False, ignore_errors=False,
+              journal=None):
+    """Store a Synapse File entity for one row of a Synapse manifest.
+
+    If the file handle has no ID, it is created first as an external S3
+    file handle.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        row: A dictionary of File entity properties and annotations.
+        file_handle: A file handle for the row from `create_synapse_filehandles`.
+        verbose: Log each stored entity.
+        ignore_errors: Log errors instead of raising them. A row whose file
+                       handle could not be created is skipped.
+        journal: A StoreJournal to skip completed work with and record
+                 progress in.
+    Returns:
+        The stored synapseclient.File, or None if the row was skipped.
+        For rows already completed in the journal, a File built from the
+        journal record, without querying Synapse.
+    """
+
+    a = dict(row)
+
+    fingerprint = None
+    if journal is not None:
+        fingerprint = row_fingerprint(row)
+
+        if fingerprint in journal.entities:
+            record = journal.entities[fingerprint]
+            a.update(id=record['entityId'],
+                     dataFileHandleId=record['dataFileHandleId'],
+                     versionNumber=record['versionNumber'])
+            return synapseclient.File(**a)
+
+        if fingerprint in journal.file_handle_ids and not file_handle.get('id'):
+            file_handle = dict(file_handle, id=journal.file_handle_ids[fingerprint])
+            a['dataFileHandleId'] = file_handle['id']
+
+    if not file_handle.get('id'):
+        try:
+            stored_file_handle = _call("synapse.create_filehandle", syn.restPOST,
+                                       '/externalFileHandle/s3',
+                                       json.dumps(file_handle),
+                                       endpoint=syn.fileHandleEndpoint)
+            a['dataFileHandleId'] = stored_file_handle['id']
+            if journal is not None:
+                journal.record_file_handle(fingerprint, stored_file_handle['id'])
+        except Exception as e:
+            logger.error("File handle: %s" % (file_handle,))
+            if ignore_errors:
+                return None
+            else:
+                raise e
+    else:
+        if file_handle['id'] != a['dataFileHandleId']:
+            if ignore_errors:
+                logger.error("Not equal: %s != %s" % (file_handle['id'],
+                                                      a['dataFileHandleId']))
+            else:
+                raise ValueError("Not equal: %s != %s" % (file_handle['id'],
                                                           a['dataFileHandleId']))
-                else:
-                    raise ValueError("Not equal: %s != %s" % (file_handle['id'],
-                                                              a['dataFileHandleId']))
 
-        f = synapseclient.File(**a)
-        f = syn.store(f, forceVersion=False)
+    f = synapseclient.File(**a)
+    f = _call("synapse.store_entity", syn.store, f, forceVersion=False)
+
+    if journal is not None:
+        journal.record_entity(fingerprint, f)
+
+    if verbose:
+        logger.debug("Stored %s (%s) to parentId %s" % (a.get('name'), f.id, a.get('parentId')))
+
+    return f
+
+
+# Manifest columns that are not entity properties or annotations
+NON_ANNOTATION_COLUMNS = ('path', )
+
+
+def _normalize_value(value):
+    """Normalize a manifest or file view value so they can be compared."""
+
+    if isinstance(value, (list, tuple)):
+        if len(value) != 1:
+            return [_normalize_value(x) for x in value]
+        value = value[0]
+
+    try:
+        if pandas.isnull(value):
+            return None
+    except (TypeError, ValueError):
+        pass
+
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+
+    return str(value)
+
+
+def annotations_hash(values, keys):
+    """Get a stable hash of the values of some keys of an entity or manifest row."""
+
+    data = json.dumps([[key, _normalize_value(values.get(key))] for key in keys])
+
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def query_file_view_by_parents(syn, file_view_id, parent_ids):
+    """Query all columns of a file view for the files in some folders.
+
+    Returns:
+        The synapseclient query result.
+    """
+
+    query = "select * from %s where parentId in (%s)" % (file_view_id,
+                                                         ",".join("'%s'" % x for x in parent_ids))
+
+    return _call("synapse.table_query", syn.tableQuery, query)
+
+
+@timed("synapse.get_unchanged_entity_ids")
+def get_unchanged_entity_ids(syn, rows, filehandles, file_view_id):
+    """Find the manifest rows whose entities in a file view are already up to date.
+
+    Entities are matched to rows by parent and name. An entity is up to date
+    if it has the row's file handle and the same values for every manifest
+    column that is also a file view column. Manifest columns missing from the
+    file view can not be compared, so rows with them are never unchanged.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        rows: A list of dictionaries of File entity properties and annotations.
+        filehandles: A list of file handles, one per row.
+        file_view_id: Synapse ID of a file view including the entities.
+    Returns:
+        A list with the entity ID for each unchanged row, and None for rows
+        that need to be stored.
+    """
+
+    parent_ids = sorted(set(str(row['parentId']) for row in rows))
+
+    if not parent_ids:
+        return []
+
+    current = query_file_view_by_parents(syn, file_view_id, parent_ids).asDataFrame()
 
-        if verbose:
-            logger.debug("Stored %s (%s) to parentId %s" % (row.name, f.id, row.parentId))
+    row_keys = set().union(*[row.keys() for row in rows]) - set(NON_ANNOTATION_COLUMNS)
+    compare_keys = sorted(row_keys.intersection(current.columns))
+    uncovered_keys = sorted(row_keys.difference(current.columns))
 
-        f_list.append(f)
+    if uncovered_keys:
+        logger.warning("Columns not in file view %s can not be checked for changes, "
+                       "so rows with them will be stored: %s" %
+                       (file_view_id, uncovered_keys))
+
+    current_entities = {(x['parentId'], x['name']): x
+                        for x in current.to_dict(orient='records')}
+
+    entity_ids = []
+
+    for row, file_handle in zip(rows, filehandles):
+        entity = current_entities.get((str(row['parentId']), row['name']))
+
+        if entity is None or not file_handle.get('id') or \
+                any(key in row for key in uncovered_keys) or \
+                str(file_handle['id']) != str(entity['dataFileHandleId']) or \
+                annotations_hash(row, compare_keys) != annotations_hash(entity, compare_keys):
+            entity_ids.append(None)
+        else:
+            entity_ids.append(entity['id'])
+
+    logger.info("%s of %s rows are unchanged in %s" %
+                (sum(x is not None for x in entity_ids), len(rows), file_view_id))
+
+    return entity_ids
+
+
+@timed("synapse.store")
+def store(syn, synapse_manifest, filehandles, verbose=False, ignore_errors=False,
+          parallel=4, journal=None, file_view_id=None):
+    """Store File entities for a Synapse manifest in parallel threads.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        synapse_manifest: A data frame of File entity properties and
+                          annotations, one row per file.
+        filehandles: A list of file handles, one per manifest row, from
+                     `create_synapse_filehandles`.
+        verbose: Log each stored entity.
+        ignore_errors: See `store_row`.
+        parallel: Number of rows to store at the same time.
+        journal: A StoreJournal to resume an interrupted run from; see
+                 `store_row`.
+        file_view_id: A file view including the target entities. If given,
+                      rows whose entities are unchanged are not stored; see
+                      `get_unchanged_entity_ids`.
+    Returns:
+        A list of the stored synapseclient.File entities in manifest order,
+        without rows that were skipped. Unchanged rows are Files built from
+        the manifest row and the existing entity ID.
+    """
+
+    rows = [x.to_dict() for (i, x) in synapse_manifest.iterrows()]
+
+    if file_view_id is not None:
+        entity_ids = get_unchanged_entity_ids(syn, rows, filehandles, file_view_id)
+    else:
+        entity_ids = [None] * len(rows)
+
+    def worker(task):
+        row, file_handle, entity_id = task
+        if entity_id is not None:
+            return synapseclient.File(**dict(row, id=entity_id))
+        return store_row(syn, row, file_handle, verbose=verbose,
+                         ignore_errors=ignore_errors, journal=journal)
+
+    pool = multiprocessing.dummy.Pool(parallel)
+
+    try:
+        f_list = [f for f in pool.imap(worker, zip(rows, filehandles, entity_ids))
+                  if f is not None]
+    finally:
+        pool.terminate()
 
     return f_list
+
+
+# File view columns that are entity properties, not annotations
+ENTITY_VIEW_COLUMNS = ('id', 'name', 'createdOn', 'createdBy', 'etag', 'type',
+                       'currentVersion', 'parentId', 'benefactorId', 'projectId',
+                       'modifiedOn', 'modifiedBy', 'dataFileHandleId',
+                       'dataFileSizeBytes', 'dataFileMD5Hex', 'dataFileConcreteType',
+                       'dataFileBucket', 'dataFileKey', 'path')
+
+
+def _native_value(value):
+    """Convert a manifest value to a JSON serializable value for a table update."""
+
+    if _normalize_value(value) is None:
+        return None
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+@timed("synapse.get_annotation_changes")
+def get_annotation_changes(syn, manifest, file_view_id):
+    """Find the annotation values that differ between a manifest and a file view.
+
+    Entities are matched to manifest rows by parent and name. Only manifest
+    columns that are also annotation columns of the file view are compared.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        manifest: A data frame with 'name' and 'parentId' columns plus
+                  annotation columns.
+        file_view_id: Synapse ID of a file view including the entities.
+    Returns:
+        A tuple of a dictionary of changes, in the form
+        {ROW_ID: {COLUMN_NAME: NEW_VALUE}}, and the file view query result.
+    """
+
+    rows = manifest.to_dict(orient='records')
+    parent_ids = sorted(set(str(row['parentId']) for row in rows))
+
+    query_result = query_file_view_by_parents(syn, file_view_id, parent_ids)
+    current = query_result.asDataFrame()
+
+    annotation_columns = [col for col in manifest.columns
+                          if col in current.columns and col not in ENTITY_VIEW_COLUMNS]
+
+    current_entities = {(x['parentId'], x['name']): x
+                        for x in current.to_dict(orient='records')}
+
+    changes = {}
+    missing = 0
+
+    for row in rows:
+        entity = current_entities.get((str(row['parentId']), row['name']))
+
+        if entity is None:
+            missing += 1
+            continue
+
+        row_changes = {col: _native_value(row[col]) for col in annotation_columns
+                       if _normalize_value(row[col]) != _normalize_value(entity[col])}
+
+        if row_changes:
+            # The row ID of a file in a file view is its Synapse ID number
+            changes[int(entity['id'].replace('syn', ''))] = row_changes
+
+    if missing:
+        logger.warning("%s manifest rows have no file in %s and are not updated" %
+                       (missing, file_view_id))
+
+    logger.info("%s of %s files have changed annotations in columns %s" %
+                (len(changes), len(rows), annotation_columns))
+
+    return changes, query_result
+
+
+@timed("synapse.update_annotations")
+def update_annotations(syn, manifest, file_view_id, chunk_size=1000, dry_run=False):
+    """Update changed annotations with partial row updates to a file view.
+
+    Changes are found with `get_annotation_changes` and applied as table
+    transactions of up to chunk_size files each, instead of storing each
+    entity.
+
+    Args:
+        syn: A synapseclient.Synapse object.
+        manifest: See `get_annotation_changes`.
+        file_view_id: Synapse ID of a file view including the entities.
+        chunk_size: Maximum number of files to update in each transaction.
+        dry_run: Find the changes without applying them.
+    Returns:
+        The changes, as returned by `get_annotation_changes`.
+    """
+
+    changes, query_result = get_annotation_changes(syn, manifest, file_view_id)
+
+    if dry_run:
+        return changes
+
+    items = list(changes.items())
+
+    for start in range(0, len(items), chunk_size):
+        chunk = dict(items[start:start + chunk_size])
+        _call("synapse.store_rowset", syn.store,
+              synapseclient.PartialRowset.from_mapping(chunk, query_result))
+        logger.info("Updated annotations for %s of %s files" %
+                    (start + len(chunk), len(items)))
+
+    return changes
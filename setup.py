@@ -26,5 +26,6 @@ setup(name='ndasynapse',
                         'boto>=2.46.1',
                         'requests>=2.18.1',
                         'deprecated==1.2.4'],
-      scripts=['bin/nda_to_synapse_manifest.py', 'bin/manifest_to_synapse.py', 'bin/query-nda', 'bin/manifest_guid_data.py'],
+      extras_require={'snapshot': ['pyarrow>=0.15.0']},
+      scripts=['bin/nda_to_synapse_manifest.py', 'bin/manifest_to_synapse.py', 'bin/query-nda', 'bin/manifest_guid_data.py', 'bin/update_annotations.py'],
       zip_safe=False)
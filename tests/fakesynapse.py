@@ -0,0 +1,266 @@
+"""An in-process stand-in for synapseclient.Synapse.
+
+FakeSynapse implements the subset of the Synapse client used by
+ndasynapse.synapse and bin/manifest_to_synapse.py, keeping entities and
+file handles in memory. Each call can be given a latency and can fail at
+random or on demand, so the sync path can be tested and benchmarked at
+scale without a Synapse account.
+
+Supported calls:
+    restGET: /entity/md5/{md5}, /entity/{id}/version/{version}/filehandles,
+             /storageLocation/{id}
+    restPOST: /externalFileHandle/s3, /fileHandle/batch
+    store (File entities), get, getAnnotations, tableQuery (file view
+    queries as used in ndasynapse.synapse, including count(*) and max()
+    aggregates) and _getFileHandle.
+
+"""
+
+import collections
+import itertools
+import json
+import random
+import re
+import threading
+import time
+
+import pandas
+
+VIEW_COLUMNS = ('id', 'name', 'parentId', 'currentVersion', 'dataFileHandleId',
+                'dataFileMD5Hex', 'modifiedOn')
+
+class FakeSynapseError(Exception):
+    """An error raised by FakeSynapse for an injected or unsupported call."""
+
+
+class FakeQueryResult(object):
+    """The result of FakeSynapse.tableQuery."""
+
+    def __init__(self, df):
+        self.df = df
+
+    def asDataFrame(self):
+        return self.df.copy()
+
+
+class FakeSynapse(object):
+    """An in-memory Synapse client.
+
+    Args:
+        latency: Seconds to sleep in every call, or a function taking the
+                 call name and URI and returning the seconds to sleep.
+        failure_rate: Probability that a call raises FakeSynapseError.
+        fail_on: A function taking the call name and URI and returning True
+                 if the call should raise FakeSynapseError.
+        seed: Seed for the random failures.
+    """
+
+    fileHandleEndpoint = "https://file-prod.prod.sagebase.org/file/v1"
+
+    def __init__(self, latency=0, failure_rate=0, fail_on=None, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.fail_on = fail_on
+
+        self.entities = {}
+        self.filehandles = {}
+        self.annotations = collections.defaultdict(dict)
+        self.storage_locations = {}
+        self.calls = collections.Counter()
+
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def _call(self, name, uri=None):
+        """Count a call, then apply the latency and failure injection."""
+
+        with self._lock:
+            self.calls[name] += 1
+            fail = self._random.random() < self.failure_rate
+
+        latency = self.latency(name, uri) if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        if fail or (self.fail_on is not None and self.fail_on(name, uri)):
+            raise FakeSynapseError(f"Injected failure for {name} {uri}")
+
+    def _next_id(self):
+        with self._lock:
+            return next(self._ids)
+
+    # Setup helpers
+
+    def add_filehandle(self, **filehandle):
+        """Add a file handle, returning it with a new 'id'."""
+
+        filehandle = dict(filehandle, id=str(self._next_id()))
+        self.filehandles[filehandle['id']] = filehandle
+        return filehandle
+
+    def add_entity(self, name, parentId, dataFileHandleId, **annotations):
+        """Add a File entity, returning its properties and annotations."""
+
+        entity = {'id': f"syn{self._next_id()}", 'name': name,
+                  'parentId': parentId, 'versionNumber': 1,
+                  'dataFileHandleId': str(dataFileHandleId),
+                  'modifiedOn': int(time.time() * 1000)}
+        entity.update(annotations)
+        self.entities[entity['id']] = entity
+        return entity
+
+    # synapseclient.Synapse methods
+
+    def restGET(self, uri, endpoint=None, **kwargs):
+        self._call('restGET', uri)
+
+        match = re.match(r"^/entity/md5/(\w+)$", uri)
+        if match:
+            return {'results': [{'id': x['id'], 'versionNumber': x['versionNumber'],
+                                 'parentId': x['parentId'], 'name': x['name']}
+                                for x in self._entities_by_md5(match.group(1))]}
+
+        match = re.match(r"^/entity/(syn\d+)/version/(\d+)/filehandles$", uri)
+        if match:
+            entity = self.entities[match.group(1)]
+            return {'list': [self.filehandles[entity['dataFileHandleId']]]}
+
+        match = re.match(r"^/storageLocation/(\d+)$", uri)
+        if match:
+            return self.storage_locations.get(
+                match.group(1),
+                {'storageLocationId': int(match.group(1)), 'bucket': 'nda-bsmn'})
+
+        raise FakeSynapseError(f"Unsupported GET {uri}")
+
+    def restPOST(self, uri, body, endpoint=None, **kwargs):
+        self._call('restPOST', uri)
+
+        body = json.loads(body)
+
+        if uri == '/externalFileHandle/s3':
+            return self.add_filehandle(**body)
+
+        if uri == '/fileHandle/batch':
+            requested_files = []
+            for requested in body['requestedFiles']:
+                fileHandle = self.filehandles.get(str(requested['fileHandleId']))
+                if fileHandle is None:
+                    requested_files.append({'fileHandleId': requested['fileHandleId'],
+                                            'failureCode': 'NOT_FOUND'})
+                else:
+                    requested_files.append({'fileHandleId': requested['fileHandleId'],
+                                            'fileHandle': fileHandle})
+            return {'requestedFiles': requested_files}
+
+        raise FakeSynapseError(f"Unsupported POST {uri}")
+
+    def _getFileHandle(self, fileHandle):
+        self._call('_getFileHandle', fileHandle)
+        return self.filehandles[str(fileHandle)]
+
+    def store(self, obj, forceVersion=True, **kwargs):
+        self._call('store', getattr(obj, 'name', None))
+
+        properties = dict(obj.properties)
+        annotations = {key: value[0] if isinstance(value, list) and len(value) == 1 else value
+                       for key, value in dict(obj.annotations).items()}
+
+        with self._lock:
+            existing = properties.get('id') and self.entities.get(properties['id'])
+            if not existing:
+                existing = next((x for x in self.entities.values()
+                                 if x['parentId'] == properties.get('parentId') and
+                                 x['name'] == properties.get('name')), None)
+
+            if existing:
+                entity = existing
+                if str(properties.get('dataFileHandleId')) != entity['dataFileHandleId']:
+                    entity['versionNumber'] += 1
+            else:
+                entity = {'id': f"syn{next(self._ids)}", 'versionNumber': 1}
+                self.entities[entity['id']] = entity
+
+            entity.update(annotations)
+            entity.update(name=properties.get('name'),
+                          parentId=properties.get('parentId'),
+                          dataFileHandleId=str(properties.get('dataFileHandleId')),
+                          modifiedOn=int(time.time() * 1000))
+
+        obj.id = entity['id']
+        obj.versionNumber = entity['versionNumber']
+        return obj
+
+    def get(self, entity, version=None, **kwargs):
+        self._call('get', entity)
+        return dict(self.entities[entity])
+
+    def getAnnotations(self, entity, **kwargs):
+        self._call('getAnnotations', entity)
+        return {key: [value] for key, value in self.annotations[entity].items()}
+
+    def tableQuery(self, query, **kwargs):
+        self._call('tableQuery', query)
+
+        match = re.match(r"^select (.+?) from (syn\d+)(?: where (.+))?$", query.strip(),
+                         flags=re.IGNORECASE)
+        if not match:
+            raise FakeSynapseError(f"Unsupported query {query}")
+
+        columns, _, where = match.groups()
+
+        df = pandas.DataFrame([self._view_row(x) for x in self.entities.values()])
+        df = df.reindex(columns=list(VIEW_COLUMNS) +
+                        [x for x in df.columns if x not in VIEW_COLUMNS])
+
+        if where:
+            df = self._filter(df, where)
+
+        columns = [x.strip() for x in columns.split(",")]
+        aggregates = [re.match(r"^(count|max)\((\*|\w+)\)$", x, flags=re.IGNORECASE)
+                      for x in columns]
+
+        if all(aggregates):
+            row = {}
+            for column, aggregate in zip(columns, aggregates):
+                function, argument = aggregate.groups()
+                if function.lower() == "count":
+                    row[column.upper()] = df.shape[0]
+                else:
+                    row[column.upper()] = df[argument].max() if df.shape[0] else None
+            df = pandas.DataFrame([row])
+        elif columns != ["*"]:
+            df = df.reindex(columns=columns)
+
+        return FakeQueryResult(df.reset_index(drop=True))
+
+    # Internals
+
+    def _entities_by_md5(self, md5):
+        return [x for x in self.entities.values()
+                if self.filehandles.get(x['dataFileHandleId'], {}).get('contentMd5') == md5]
+
+    def _view_row(self, entity):
+        row = dict(entity)
+        row['currentVersion'] = row.pop('versionNumber')
+        filehandle = self.filehandles.get(entity['dataFileHandleId'], {})
+        row['dataFileMD5Hex'] = filehandle.get('contentMd5')
+        return row
+
+    def _filter(self, df, where):
+        match = re.match(r"^(\w+) in \((.*)\)$", where, flags=re.IGNORECASE)
+        if match:
+            values = [x.strip().strip("'") for x in match.group(2).split(",")]
+            return df[df[match.group(1)].isin(values)]
+
+        match = re.match(r"^(\w+) (>=|>|=) (\d+)$", where)
+        if match:
+            column, operator, value = match.group(1), match.group(2), int(match.group(3))
+            if operator == ">=":
+                return df[df[column] >= value]
+            if operator == ">":
+                return df[df[column] > value]
+            return df[df[column] == value]
+
+        raise FakeSynapseError(f"Unsupported where clause {where}")
@@ -0,0 +1,18 @@
+import ndasynapse
+
+
+def test_lru_cache():
+    cache = ndasynapse.cache.LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    # 'b' was the least recently used
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+    expired = ndasynapse.cache.LRUCache(max_age=-1)
+    expired.put('a', 1)
+    assert expired.get('a') is None
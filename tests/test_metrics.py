@@ -0,0 +1,76 @@
+import json
+from unittest.mock import Mock, patch
+
+import pytest
+import requests
+import ndasynapse
+import fakesynapse
+
+
+def test_histogram():
+    histogram = ndasynapse.metrics.Histogram()
+    assert histogram.percentile(50) is None
+
+    for value in range(1, 101):
+        histogram.add(value / 100.0)
+
+    assert histogram.count == 100
+    assert histogram.max == 1.0
+    # Within a bucket width of the exact percentiles
+    assert 0.5 <= histogram.percentile(50) <= 0.5 * ndasynapse.metrics.BUCKET_GROWTH
+    assert 0.99 <= histogram.percentile(99) <= 1.0
+    assert histogram.percentile(100) == 1.0
+    assert len(histogram._buckets) < 100
+
+
+def test_disabled_metrics():
+    metrics = ndasynapse.metrics.Metrics(enabled=False)
+
+    with metrics.request("nda.guid"):
+        pass
+    metrics.record_stage("nda.process_samples", 1.0)
+
+    assert metrics.summary()['requests'] == {}
+    assert metrics.summary()['stages'] == {}
+
+
+def test_request_errors():
+    metrics = ndasynapse.metrics.Metrics()
+
+    with metrics.request("nda.guid") as record:
+        record.status_code = 200
+        record.nbytes = 10
+
+    with pytest.raises(requests.HTTPError):
+        with metrics.request("nda.guid"):
+            raise requests.HTTPError(response=Mock(status_code=503))
+
+    summary = metrics.summary()['requests']['nda.guid']
+    assert summary['count'] == 2
+    assert summary['errors'] == 1
+    assert summary['bytes'] == 10
+    assert summary['status_codes'] == {'200': 1, '503': 1}
+
+
+@patch('ndasynapse.nda.requests.get')
+def test_nda_and_synapse_metrics(mock_get, tmp_path):
+    ndasynapse.metrics.metrics.enable()
+
+    try:
+        mock_get.return_value = Mock(ok=False, status_code=404, content=b"not found")
+        assert ndasynapse.nda.get_submission(auth=None, submissionid=12345) is None
+
+        syn = fakesynapse.FakeSynapse()
+        ndasynapse.synapse.get_existing_filehandle(syn, "md5a")
+
+        stats_file = str(tmp_path / "stats.json")
+        ndasynapse.metrics.write_stats(stats_file)
+    finally:
+        ndasynapse.metrics.metrics.enabled = False
+    with open(stats_file) as f:
+        stats = json.load(f)
+
+    assert stats['requests']['nda.submission']['status_codes'] == {'404': 1}
+    assert stats['requests']['nda.submission']['bytes'] == 9
+    assert stats['requests']['synapse.entity_md5']['count'] == 1
+    assert list(stats['stages']) == ['synapse.resolve_existing_filehandles']
@@ -1,4 +1,7 @@
 import json
+import multiprocessing.dummy
+import pytest
+import pandas
 import requests
 from unittest.mock import Mock, patch
 
@@ -400,6 +403,103 @@ def test_get_subject(mock_get):
     assert_list_equal([response], [data])
 
 
+@patch('ndasynapse.nda.requests.get')
+def test_get_guid_structures(mock_get):
+    def get(url, **kwargs):
+        response = Mock(ok=True)
+        response.json.return_value = {'url': url}
+        return response
+
+    mock_get.side_effect = get
+
+    pool = multiprocessing.dummy.Pool(3)
+    try:
+        for structure_pool in (None, pool):
+            data = ndasynapse.nda.get_guid_structures(auth=None, guid="NDAR_XXXXXXXXXXX",
+                                                      pool=structure_pool)
+
+            assert set(data) == set(ndasynapse.nda.SHORT_NAMES)
+            for short_name, guid_data in data.items():
+                assert guid_data['url'].endswith(f"short_name={short_name}")
+    finally:
+        pool.terminate()
+
+
+def test_split_guid_data():
+    guid_data = dict(_guid_data_genomics_subject02_example)
+    guid_data["age"] = (_guid_data_genomics_subject02_example["age"] +
+                        _guid_data_genomics_sample03_example["age"])
+
+    split_data = ndasynapse.nda.split_guid_data(guid_data)
+
+    assert set(split_data) == {"genomics_subject02", "genomics_sample03"}
+    assert split_data["genomics_subject02"]["age"] == _guid_data_genomics_subject02_example["age"]
+    assert split_data["genomics_sample03"]["age"] == _guid_data_genomics_sample03_example["age"]
+
+
+@patch('ndasynapse.nda.requests.get')
+def test_combine_guid_requests(mock_get):
+    guid_data = dict(_guid_data_genomics_subject02_example)
+    guid_data["age"] = (_guid_data_genomics_subject02_example["age"] +
+                        _guid_data_genomics_sample03_example["age"])
+
+    mock_get.return_value = Mock(ok=True)
+    mock_get.return_value.json.return_value = guid_data
+
+    with patch.multiple('ndasynapse.nda', combine_guid_data=False,
+                        guid_data_cache=None):
+        ndasynapse.nda.combine_guid_requests(max_age=3600)
+        assert ndasynapse.nda.guid_data_cache.max_age == 3600
+
+        samples = ndasynapse.nda.get_samples(auth=None, guid="NDAR_XXXXXXXXXXX")
+        subjects = ndasynapse.nda.get_subjects(auth=None, guid="NDAR_XXXXXXXXXXX")
+        tissues = ndasynapse.nda.get_tissues(auth=None, guid="NDAR_XXXXXXXXXXX")
+        structures = ndasynapse.nda.get_guid_structures(auth=None, guid="NDAR_XXXXXXXXXXX")
+
+    assert mock_get.call_count == 1
+    assert samples["age"] == _guid_data_genomics_sample03_example["age"]
+    assert subjects["age"] == _guid_data_genomics_subject02_example["age"]
+    assert tissues["age"] == []
+    assert structures["genomics_sample03"] == samples
+
+
+def test_process_submissions_have_fixed_columns():
+    # Output of these can be streamed with their columns known up front
+    assert_list_equal(ndasynapse.nda.process_submissions(None).columns.tolist(),
+                      ndasynapse.nda.SUBMISSION_COLUMNS)
+    assert_list_equal(ndasynapse.nda.process_submission_files([]).columns.tolist(),
+                      ndasynapse.nda.SUBMISSION_FILE_COLUMNS)
+
+
+def test_process_guid_samples_and_subjects():
+    samples = ndasynapse.nda.process_guid_samples(
+        "NDAR_XXXXXXXXXXX", _guid_data_genomics_sample03_example)
+    subjects = ndasynapse.nda.process_guid_subjects(
+        "NDAR_XXXXXXXXXXX", _guid_data_genomics_subject02_example)
+
+    for data in (samples, subjects):
+        assert data.columns[0] == "guid"
+        assert (data.guid == "NDAR_XXXXXXXXXXX").all()
+
+
+def test_process_guid_data_drop_duplicates():
+    import copy
+
+    guid_data = copy.deepcopy(_guid_data_genomics_sample03_example)
+    ds_rows = guid_data["age"][0]["dataStructureRow"]
+    duplicate = copy.deepcopy(ds_rows[0])
+    for element in duplicate["dataElement"]:
+        if element["name"] == "GENOMICS_SAMPLE03_ID":
+            element["value"] = "another id"
+    ds_rows.append(duplicate)
+
+    data = ndasynapse.nda.process_guid_data(guid_data)
+    unique_data = ndasynapse.nda.process_guid_data(guid_data, drop_duplicates=True)
+
+    assert data.shape[0] == unique_data.shape[0] + 1
+    assert "GENOMICS_SAMPLE03_ID" not in unique_data.columns
+
+
 @patch('ndasynapse.nda.requests.get')
 def test_get_submission(mock_get):
     data = _submission_data_example
@@ -444,3 +544,216 @@ def test_get_experiment_ids():
         data_structure_row=row)
 
     assert submission_ids == set([123])
+
+
+_genomics_sample_manifest_example = b'''"genomics_sample","03"
+"subjectkey","src_subject_id","sample_id_original"
+"NDAR_XXXXXXXXXXX","1111","sample1"
+"NDAR_YYYYYYYYYYY","2222","sample2"
+"NDAR_XXXXXXXXXXX","1111","sample3"
+'''
+
+
+def test_get_manifest_guids():
+    data_files = [{'content': b'"genomics_subject","02"\nsubjectkey\nNDAR_ZZZZZZZZZZZ\n'},
+                  {'content': _genomics_sample_manifest_example}]
+
+    guids = ndasynapse.nda.get_manifest_guids(data_files, "genomics_sample",
+                                              chunksize=1)
+
+    assert guids == set(["NDAR_XXXXXXXXXXX", "NDAR_YYYYYYYYYYY"])
+
+
+def test_get_manifest_guids_no_manifest():
+    data_files = [{'content': _genomics_sample_manifest_example}]
+
+    guids = ndasynapse.nda.get_manifest_guids(data_files, "nichd_btb")
+
+    assert guids is None
+
+
+def _fake_nda_get(calls, failed_downloads=0):
+    """Make a fake requests.get for the NDA Submission API, recording URLs.
+
+    The first `failed_downloads` file downloads fail with a 503.
+    """
+
+    failures = [failed_downloads]
+
+    files = [{"id": 1, "file_type": "Submission Data File",
+              "file_remote_path": "s3://NDAR_Central_3/submission_12345/genomics_sample03.csv",
+              "status": "Complete", "md5sum": "abc", "size": 10,
+              "created_date": None, "modified_date": None,
+              "_links": {"download": {"href": "https://nda.nih.gov/download/1"}}}]
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        response = Mock(ok=True)
+        if url == "https://nda.nih.gov/api/submission/":
+            response.json.return_value = [_submission_data_example]
+        elif url.endswith("/files"):
+            response.json.return_value = files
+        elif url.startswith("https://nda.nih.gov/api/submission/"):
+            response.json.return_value = _submission_data_example
+        elif failures[0] > 0:
+            failures[0] -= 1
+            response.ok = False
+            response.status_code = 503
+            response.content = b"Service Unavailable"
+        else:
+            response.content = _genomics_sample_manifest_example
+        return response
+
+    return fake_get
+
+
+def test_collection_state_skips_unchanged_submissions(tmp_path):
+    state_file = str(tmp_path / "collection_1234.json")
+
+    calls = []
+    with patch("ndasynapse.nda.requests.get", side_effect=_fake_nda_get(calls)):
+        collection = ndasynapse.nda.NDACollection(auth=None, collection_id=1234,
+                                                  state_file=state_file)
+    assert len(calls) == 4
+
+    calls = []
+    with patch("ndasynapse.nda.requests.get", side_effect=_fake_nda_get(calls)):
+        cached = ndasynapse.nda.NDACollection(auth=None, collection_id=1234,
+                                              state_file=state_file)
+
+    assert calls == ["https://nda.nih.gov/api/submission/"]
+    assert cached.guids == collection.guids
+    assert cached.get_collection_manifests("genomics_sample").shape == (3, 5)
+
+    # File contents are kept out of the state file
+    with open(state_file) as f:
+        state = json.load(f)
+    assert state["submissions"]["12345"]["contents"] == ["1"]
+    assert (tmp_path / "collection_1234_contents" / "12345" / "1").read_bytes() == \
+        _genomics_sample_manifest_example
+
+
+def test_collection_state_in_new_directory_without_submissions(tmp_path):
+    state_file = tmp_path / "state" / "collection_1234.json"
+
+    with patch("ndasynapse.nda.requests.get") as mock_get:
+        mock_get.return_value = Mock(ok=True)
+        mock_get.return_value.json.return_value = []
+        collection = ndasynapse.nda.NDACollection(auth=None, collection_id=1234,
+                                                  state_file=str(state_file))
+
+    assert collection.submissions == []
+    assert json.loads(state_file.read_text())["submissions"] == {}
+
+
+def test_collection_state_retries_failed_downloads(tmp_path):
+    state_file = str(tmp_path / "collection_1234.json")
+
+    calls = []
+    with patch("ndasynapse.nda.requests.get",
+               side_effect=_fake_nda_get(calls, failed_downloads=1)):
+        collection = ndasynapse.nda.NDACollection(auth=None, collection_id=1234,
+                                                  state_file=state_file)
+    assert collection.guids == set()
+
+    with open(state_file) as f:
+        state = json.load(f)
+    assert state["submissions"]["12345"]["contents"] == []
+    assert not (tmp_path / "collection_1234_contents" / "12345" / "1").exists()
+
+    calls = []
+    with patch("ndasynapse.nda.requests.get", side_effect=_fake_nda_get(calls)):
+        retried = ndasynapse.nda.NDACollection(auth=None, collection_id=1234,
+                                               state_file=state_file)
+
+    assert calls == ["https://nda.nih.gov/api/submission/",
+                     "https://nda.nih.gov/download/1"]
+    assert retried.guids == set(["NDAR_XXXXXXXXXXX", "NDAR_YYYYYYYYYYY"])
+
+
+def test_snapshot_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+
+    calls = []
+    with patch("ndasynapse.nda.requests.get", side_effect=_fake_nda_get(calls)):
+        collection = ndasynapse.nda.NDACollection(auth=None, collection_id=1234)
+
+    samples = ndasynapse.nda.process_guid_data(_guid_data_genomics_sample03_example)
+
+    snapshot_dir = str(tmp_path / "snapshot")
+    index = ndasynapse.snapshot.write_snapshot(snapshot_dir, [collection],
+                                               frames={"genomics_sample03": samples})
+
+    assert index["tables"]["guids"]["rows"] == 2
+
+    tables = ndasynapse.snapshot.read_snapshot(snapshot_dir)
+
+    assert set(tables["guids"].guid) == collection.guids
+    assert tables["submission_files"].shape[0] == 1
+    assert_list_equal(tables["genomics_sample03"].columns.tolist(),
+                      samples.columns.tolist())
+
+    # Scripts read the same table from a snapshot or from CSV output
+    samples_file = str(tmp_path / "samples.csv")
+    samples.to_csv(samples_file, index=False)
+    for path in (snapshot_dir, samples_file):
+        table = ndasynapse.snapshot.read_table(path, "genomics_sample03")
+        assert table.shape == samples.shape
+
+
+def test_lazy_collection():
+    calls = []
+    with patch("ndasynapse.nda.requests.get", side_effect=_fake_nda_get(calls)):
+        collection = ndasynapse.nda.LazyNDACollection(auth=None, collection_id=1234)
+        assert calls == []
+
+        guids = list(collection.iter_guids())
+        rows = list(collection.iter_manifest_rows("genomics_sample"))
+
+    assert sorted(guids) == ["NDAR_XXXXXXXXXXX", "NDAR_YYYYYYYYYYY"]
+    assert len(rows) == 3
+    assert rows[0]["submission_id"] == "12345"
+
+
+def test_get_collections_shares_listing():
+    calls = []
+    with patch("ndasynapse.nda.requests.get", side_effect=_fake_nda_get(calls)):
+        collections = ndasynapse.nda.get_collections(auth=None,
+                                                     collection_ids=[1234, 5678])
+
+    assert calls.count("https://nda.nih.gov/api/submission/") == 1
+    assert [c.collection_id for c in collections] == ["1234", "5678"]
+    assert len(collections[0].submissions) == 1
+    assert collections[1].submissions == []
+
+
+def test_pipeline():
+    guid_data = {'NDAR1': _guid_data_genomics_sample03_example, 'NDAR2': None}
+
+    def fetch(guid):
+        if guid_data[guid] is None:
+            return None
+        return (guid_data[guid], ['2458'])
+
+    expected = ndasynapse.nda.process_guid_data(_guid_data_genomics_sample03_example,
+                                                collection_ids=[2458],
+                                                drop_duplicates=True)
+
+    for process_parallel in (0, 2):
+        results = list(ndasynapse.nda.pipeline(
+            ['NDAR1', 'NDAR2', 'NDAR1'], fetch=fetch,
+            process=ndasynapse.nda.process_guid_collections,
+            fetch_parallel=2, process_parallel=process_parallel, max_pending=2))
+
+        assert len(results) == 2
+        for frames in results:
+            pandas.testing.assert_frame_equal(frames[0], expected)
+
+
+def test_pipeline_raises_fetch_errors():
+    def fetch(item):
+        raise requests.HTTPError("Server error")
+
+    with pytest.raises(requests.HTTPError):
+        list(ndasynapse.nda.pipeline([1, 2], fetch=fetch, process=len,
+                                     process_parallel=0))
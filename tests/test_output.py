@@ -0,0 +1,62 @@
+import io
+import json
+
+import pandas
+import pytest
+from nose.tools import assert_list_equal
+import ndasynapse
+
+
+def _frames():
+    return [pandas.DataFrame({'guid': ['NDAR1', 'NDAR1'], 'age': [10, 10]}),
+            pandas.DataFrame({'guid': ['NDAR2'], 'sample_id': ['s2']}),
+            pandas.DataFrame(),
+            pandas.DataFrame({'age': [12], 'guid': ['NDAR3']})]
+
+
+def test_write_csv_keeps_all_columns():
+    stream = io.StringIO()
+
+    rows = ndasynapse.output.write_frames(_frames(), file_format="csv", stream=stream)
+
+    assert rows == 4
+    assert_list_equal(stream.getvalue().splitlines(),
+                      ['"guid","age","sample_id"', '"NDAR1",10,""', '"NDAR1",10,""',
+                       '"NDAR2","","s2"', '"NDAR3",12,""'])
+
+
+def test_write_csv_with_columns():
+    stream = io.StringIO()
+
+    with ndasynapse.output.open_writer("csv", stream=stream, columns=['guid']) as writer:
+        writer.write(_frames()[0])
+        # Written right away with fixed columns
+        assert stream.getvalue().splitlines() == ['"guid"', '"NDAR1"', '"NDAR1"']
+        writer.write(_frames()[1])
+
+    assert stream.getvalue().splitlines()[-1] == '"NDAR2"'
+
+
+def test_write_jsonl_adds_late_columns():
+    stream = io.StringIO()
+
+    ndasynapse.output.write_frames(_frames(), file_format="jsonl", stream=stream)
+
+    records = [json.loads(x) for x in stream.getvalue().splitlines()]
+    assert records[0] == {'guid': 'NDAR1', 'age': 10}
+    assert records[2] == {'guid': 'NDAR2', 'age': None, 'sample_id': 's2'}
+    assert records[3] == {'guid': 'NDAR3', 'age': 12, 'sample_id': None}
+
+
+def test_write_parquet():
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    stream = io.BytesIO()
+
+    ndasynapse.output.write_frames(_frames(), file_format="parquet", stream=stream)
+
+    df = pyarrow.parquet.read_table(io.BytesIO(stream.getvalue())).to_pandas()
+    assert_list_equal(df.columns.tolist(), ['guid', 'age', 'sample_id'])
+    assert_list_equal(df.guid.tolist(), ['NDAR1', 'NDAR1', 'NDAR2', 'NDAR3'])
+    assert df.sample_id.tolist()[2] == 's2'
@@ -0,0 +1,63 @@
+import argparse
+import multiprocessing.dummy
+
+import pytest
+import ndasynapse
+
+
+def _work(n):
+    return ndasynapse.nda.split_bucket_and_key(f"s3://nda-bsmn/abc/file{n}.bam")
+
+
+def test_cpu_profiler_includes_threads(tmp_path):
+    profiler = ndasynapse.profiling.CPUProfiler()
+    profiler.start()
+    pool = multiprocessing.dummy.Pool(2)
+    try:
+        pool.map(_work, range(10))
+    finally:
+        pool.terminate()
+        profiler.stop()
+
+    assert len(profiler.profiles) >= 2
+
+    report = profiler.report()
+    assert "split_bucket_and_key" in report.split("ndasynapse functions by cumulative")[1]
+
+    profiler.dump(str(tmp_path / "cpu.data"))
+    assert (tmp_path / "cpu.data").exists()
+
+
+def test_memory_profiler():
+    profiler = ndasynapse.profiling.MemoryProfiler()
+    profiler.start()
+    data = [_work(n) for n in range(100)]
+    profiler.stop()
+    assert len(data) == 100
+
+    report = profiler.report()
+    assert "Traced memory" in report
+    assert "ndasynapse/nda.py" in report.split("ndasynapse allocation sites")[1]
+
+
+def test_unknown_profiler():
+    with pytest.raises(ValueError):
+        ndasynapse.profiling.start("gpu")
+
+
+def test_add_arguments_and_setup(monkeypatch):
+    parser = argparse.ArgumentParser()
+    ndasynapse.profiling.add_arguments(parser)
+
+    args = parser.parse_args([])
+    assert (args.stats, args.profile, args.profile_output) == (None, None, "-")
+
+    registered = []
+    monkeypatch.setattr(ndasynapse.profiling.atexit, "register",
+                        lambda *args: registered.append(args))
+
+    monkeypatch.setattr(ndasynapse.metrics.metrics, "enabled", False)
+
+    ndasynapse.profiling.setup(parser.parse_args(["--stats", "stats.json"]))
+    assert registered == [(ndasynapse.metrics.write_stats, "stats.json")]
+    assert ndasynapse.metrics.metrics.enabled
@@ -0,0 +1,87 @@
+import io
+import os
+import stat
+import threading
+from unittest.mock import Mock, patch
+
+import pytest
+
+import ndasynapse
+
+
+def test_server_streams_output(tmp_path):
+    def command(argv, output, errors, cwd):
+        if argv[0] == "fail":
+            raise ValueError("Bad command")
+        output.write(" ".join(argv) + f" in {cwd}\n")
+        output.flush()
+        output.buffer.write(b"binary\n")
+        return 3
+
+    address = f"unix:{tmp_path / 'server.sock'}"
+    server = ndasynapse.server.make_server(address, command)
+    assert stat.S_IMODE(os.stat(tmp_path / 'server.sock').st_mode) & 0o077 == 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        status = ndasynapse.server.request(address, ["get-samples", "--guid", "NDAR1"],
+                                           stdout=stdout, stderr=stderr, cwd="/data")
+        assert status == 3
+        assert stdout.getvalue() == b"get-samples --guid NDAR1 in /data\nbinary\n"
+
+        status = ndasynapse.server.request(address, ["fail"], stdout=stdout, stderr=stderr)
+        assert status == 1
+        assert stderr.getvalue() == b"ValueError: Bad command\n"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_tcp_server_requires_token(tmp_path, monkeypatch):
+    monkeypatch.setenv("HOME", str(tmp_path))
+
+    def command(argv, output, errors, cwd):
+        output.write("ran\n")
+        return 0
+
+    with pytest.raises(ValueError):
+        ndasynapse.server.make_server("192.0.2.1:0", command)
+
+    server = ndasynapse.server.make_server("0", command)
+    port = server.server_address[1]
+    token_file = ndasynapse.server.token_path(port)
+    assert stat.S_IMODE(os.stat(token_file).st_mode) == 0o600
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    try:
+        stdout, stderr = io.BytesIO(), io.BytesIO()
+        assert ndasynapse.server.request(f"{port}", ["get-samples"],
+                                         stdout=stdout, stderr=stderr) == 0
+        assert stdout.getvalue() == b"ran\n"
+
+        with open(token_file, 'w') as f:
+            f.write("wrong")
+        stdout = io.BytesIO()
+        assert ndasynapse.server.request(f"{port}", ["get-samples"],
+                                         stdout=stdout, stderr=stderr) == 1
+        assert stdout.getvalue() == b""
+        assert b"token" in stderr.getvalue()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@patch('ndasynapse.nda.requests.get')
+def test_nda_response_cache(mock_get):
+    mock_get.return_value = Mock(ok=True, status_code=200, content=b"{}")
+    mock_get.return_value.json.return_value = {'age': []}
+
+    with patch('ndasynapse.nda.response_cache', ndasynapse.cache.LRUCache()):
+        for _ in range(3):
+            assert ndasynapse.nda.get_samples(auth=None, guid="NDAR1") == {'age': []}
+        ndasynapse.nda.get_subjects(auth=None, guid="NDAR1")
+
+    assert mock_get.call_count == 2
@@ -0,0 +1,374 @@
+import json
+import uuid
+from unittest.mock import Mock, patch
+
+import pandas
+from nose.tools import assert_list_equal, assert_raises
+import ndasynapse
+import fakesynapse
+
+_storage_location = {'bucket': 'nda-bsmn', 'storageLocationId': 9209}
+
+_metadata_manifest = pandas.DataFrame(
+    {'data_file': ['s3://nda-bsmn/abc/file1.bam', 's3://nda-bsmn/abc/file2.bam',
+                   's3://nda-bsmn/def/file1.bam'],
+     'size': [1, 2, 1],
+     'md5': ['md5a', 'md5b', 'md5a']})
+
+
+def _fake_syn():
+    """Make a fake Synapse client where only md5a is already in Synapse."""
+
+    def rest_get(uri):
+        if uri == "/entity/md5/md5a":
+            return {'results': [{'id': 'syn1', 'versionNumber': 1}]}
+        elif uri.startswith("/entity/md5/"):
+            return {'results': []}
+        elif uri == "/entity/syn1/version/1/filehandles":
+            return {'list': [{'id': '111', 'contentMd5': 'md5a'}]}
+        raise ValueError(uri)
+
+    def rest_post(uri, body, endpoint=None):
+        assert uri == "/fileHandle/batch"
+        return {'requestedFiles': [{'fileHandleId': x['fileHandleId'],
+                                    'fileHandle': {'id': x['fileHandleId']}}
+                                   for x in json.loads(body)['requestedFiles']]}
+
+    syn = Mock(fileHandleEndpoint="https://example.org/file/v1")
+    syn.restGET.side_effect = rest_get
+    syn.restPOST.side_effect = rest_post
+    return syn
+
+
+def test_create_synapse_filehandles():
+    syn = _fake_syn()
+
+    fh_list = ndasynapse.synapse.create_synapse_filehandles(
+        syn=syn, metadata_manifest=_metadata_manifest,
+        storage_location=_storage_location, parallel=2)
+
+    assert_list_equal([fh.get('id') for fh in fh_list], ['111', None, '111'])
+    assert fh_list[1]['key'] == 'abc/file2.bam'
+    # Each distinct md5 is only looked up once
+    assert syn.restGET.call_count == 3
+
+
+def test_build_md5_index(tmp_path):
+    syn = _fake_syn()
+    view = pandas.DataFrame(
+        {'id': ['syn1', 'syn2'], 'currentVersion': [1, 3],
+         'parentId': ['syn9', 'syn9'], 'dataFileHandleId': [111, 222],
+         'dataFileMD5Hex': ['md5a', 'md5c']})
+    version = {'modifiedOn': 1000}
+
+    def table_query(query):
+        if query.startswith("select count(*)"):
+            return Mock(asDataFrame=lambda: pandas.DataFrame(
+                {'COUNT(*)': [view.shape[0]], 'MAX(modifiedOn)': [version['modifiedOn']]}))
+        return Mock(asDataFrame=lambda: view)
+
+    syn.tableQuery.side_effect = table_query
+    index_file = str(tmp_path / "md5_index.json")
+
+    md5_index = ndasynapse.synapse.build_md5_index(syn, "syn10", index_file=index_file)
+
+    assert md5_index['md5c'] == [{'id': 'syn2', 'versionNumber': 3,
+                                  'parentId': 'syn9', 'dataFileHandleId': '222'}]
+    assert ndasynapse.synapse.build_md5_index(syn, "syn10", index_file=index_file) == md5_index
+    full_queries = [c for c in syn.tableQuery.call_args_list
+                    if not c[0][0].startswith("select count(*)")]
+    assert len(full_queries) == 1
+
+    # A changed file view, or refresh, rebuilds the index
+    version['modifiedOn'] = 2000
+    ndasynapse.synapse.build_md5_index(syn, "syn10", index_file=index_file)
+    ndasynapse.synapse.build_md5_index(syn, "syn10", index_file=index_file, refresh=True)
+    full_queries = [c for c in syn.tableQuery.call_args_list
+                    if not c[0][0].startswith("select count(*)")]
+    assert len(full_queries) == 3
+
+    fh_list = ndasynapse.synapse.create_synapse_filehandles(
+        syn=syn, metadata_manifest=_metadata_manifest,
+        storage_location=_storage_location, md5_index=md5_index)
+
+    assert_list_equal([fh.get('id') for fh in fh_list], ['111', None, '111'])
+    # Only the md5 missing from the index is looked up with the REST API,
+    # and the indexed file handle is retrieved with one batch request.
+    assert syn.restGET.call_count == 1
+    assert syn.restPOST.call_count == 1
+
+
+def test_store_keeps_order_and_skips_errors():
+    syn = Mock(fileHandleEndpoint="https://example.org/file/v1")
+
+    def rest_post(uri, body, endpoint=None):
+        file_handle = json.loads(body)
+        if file_handle['key'] == 'bad':
+            raise ValueError("Could not create file handle.")
+        return {'id': "fh-" + file_handle['key']}
+
+    syn.restPOST.side_effect = rest_post
+    syn.store.side_effect = lambda f, forceVersion: f
+
+    synapse_manifest = pandas.DataFrame({'name': ['a', 'b', 'c', 'd'],
+                                         'parentId': 'syn9',
+                                         'dataFileHandleId': [None, None, None, '4']})
+    filehandles = [{'key': 'a'}, {'key': 'bad'}, {'key': 'c'}, {'id': '4'}]
+
+    f_list = ndasynapse.synapse.store(syn, synapse_manifest, filehandles,
+                                      ignore_errors=True, parallel=3)
+
+    assert_list_equal([f.name for f in f_list], ['a', 'c', 'd'])
+    assert_list_equal([f.dataFileHandleId for f in f_list], ['fh-a', 'fh-c', '4'])
+
+
+def test_store_resumes_from_journal(tmp_path):
+    journal_path = str(tmp_path / "journal.jsonl")
+
+    synapse_manifest = pandas.DataFrame({'name': ['a', 'b', 'c'],
+                                         'parentId': 'syn9',
+                                         'dataFileHandleId': None})
+    filehandles = [{'key': 'a'}, {'key': 'b'}, {'key': 'c'}]
+
+    def make_syn(fail_on):
+        syn = Mock(fileHandleEndpoint="https://example.org/file/v1")
+        syn.restPOST.side_effect = lambda uri, body, endpoint=None: \
+            {'id': "fh-" + json.loads(body)['key']}
+
+        def store(f, forceVersion):
+            if f.name == fail_on:
+                raise ValueError("Synapse is down.")
+            f.id = "syn-" + f.name
+            return f
+
+        syn.store.side_effect = store
+        return syn
+
+    syn = make_syn(fail_on='b')
+    with ndasynapse.synapse.StoreJournal(journal_path) as journal:
+        with assert_raises(ValueError):
+            ndasynapse.synapse.store(syn, synapse_manifest, filehandles,
+                                     parallel=1, journal=journal)
+
+    syn = make_syn(fail_on=None)
+    with ndasynapse.synapse.StoreJournal(journal_path) as journal:
+        f_list = ndasynapse.synapse.store(syn, synapse_manifest, filehandles,
+                                          parallel=1, journal=journal)
+
+    assert_list_equal([f.id for f in f_list], ['syn-a', 'syn-b', 'syn-c'])
+    # Row 'a' was completed and row 'b' already had its file handle. Row 'c'
+    # may have been completed by the first run's thread pool after 'b' failed.
+    reposted = [json.loads(c[0][1])['key'] for c in syn.restPOST.call_args_list]
+    restored = [c[0][0].name for c in syn.store.call_args_list]
+    assert set(reposted) <= set(['c'])
+    assert restored[0] == 'b' and 'a' not in restored
+
+
+def test_store_rerun_skips_rows_in_journal(tmp_path):
+    journal_path = str(tmp_path / "journal.jsonl")
+    metadata_manifest = pandas.DataFrame(
+        {'data_file': [f"s3://nda-bsmn/abc/file{i}.bam" for i in range(4)],
+         'size': 1,
+         'md5': [f"md5{i}" for i in range(4)]})
+
+    def run(syn):
+        # As in bin/manifest_to_synapse.py
+        fh_list = ndasynapse.synapse.create_synapse_filehandles(
+            syn, metadata_manifest, _storage_location, parallel=1)
+        synapse_manifest = metadata_manifest.copy()
+        synapse_manifest['dataFileHandleId'] = [fh.get('id') for fh in fh_list]
+        synapse_manifest['name'] = [f"file{i}.bam" for i in range(4)]
+        synapse_manifest['parentId'] = "syn123"
+
+        with ndasynapse.synapse.StoreJournal(journal_path) as journal:
+            return ndasynapse.synapse.store(syn, synapse_manifest, fh_list,
+                                            parallel=1, journal=journal)
+
+    stored = []
+    failures = ["file1.bam"]
+
+    def fail_on(name, uri):
+        if name == 'store':
+            stored.append(uri)
+            if uri in failures:
+                failures.remove(uri)
+                return True
+        return False
+
+    syn = fakesynapse.FakeSynapse(fail_on=fail_on)
+    with assert_raises(fakesynapse.FakeSynapseError):
+        run(syn)
+    assert stored[:2] == ["file0.bam", "file1.bam"]
+
+    # The rerun finds the stored entities by md5, which gives their rows
+    # file handle IDs. Row file0.bam was completed, so is not stored again.
+    del stored[:]
+    f_list = run(syn)
+
+    assert_list_equal([f.name for f in f_list], [f"file{i}.bam" for i in range(4)])
+    assert "file0.bam" not in stored and "file1.bam" in stored
+    assert len(syn.entities) == 4
+
+
+def test_store_skips_unchanged():
+    syn = Mock(fileHandleEndpoint="https://example.org/file/v1")
+    syn.store.side_effect = lambda f, forceVersion: f
+    syn.tableQuery.return_value.asDataFrame.return_value = pandas.DataFrame(
+        {'id': ['syn1', 'syn2'], 'name': ['a', 'b'], 'parentId': 'syn9',
+         'dataFileHandleId': [1, 2], 'assay': ['wholeGenomeSeq', 'exomeSeq']})
+
+    synapse_manifest = pandas.DataFrame({'name': ['a', 'b', 'c'],
+                                         'parentId': 'syn9',
+                                         'dataFileHandleId': ['1', '2', '3'],
+                                         'assay': ['wholeGenomeSeq', 'wholeGenomeSeq',
+                                                   'wholeGenomeSeq'],
+                                         'path': None})
+    filehandles = [{'id': '1'}, {'id': '2'}, {'id': '3'}]
+
+    f_list = ndasynapse.synapse.store(syn, synapse_manifest, filehandles,
+                                      file_view_id="syn10")
+
+    assert_list_equal([f.name for f in f_list], ['a', 'b', 'c'])
+    assert f_list[0].id == 'syn1'
+    assert_list_equal(sorted(c[0][0].name for c in syn.store.call_args_list), ['b', 'c'])
+
+
+def test_store_does_not_skip_columns_missing_from_view():
+    syn = Mock(fileHandleEndpoint="https://example.org/file/v1")
+    syn.store.side_effect = lambda f, forceVersion: f
+    syn.tableQuery.return_value.asDataFrame.return_value = pandas.DataFrame(
+        {'id': ['syn1'], 'name': ['a'], 'parentId': 'syn9',
+         'dataFileHandleId': [1]})
+
+    synapse_manifest = pandas.DataFrame({'name': ['a'], 'parentId': 'syn9',
+                                         'dataFileHandleId': ['1'],
+                                         'assay': ['wholeGenomeSeq']})
+
+    ndasynapse.synapse.store(syn, synapse_manifest, [{'id': '1'}],
+                             file_view_id="syn10")
+
+    assert syn.store.call_count == 1
+
+
+@patch("ndasynapse.synapse.synapseclient.PartialRowset.from_mapping")
+def test_update_annotations(mock_from_mapping):
+    syn = Mock()
+    syn.tableQuery.return_value.asDataFrame.return_value = pandas.DataFrame(
+        {'id': ['syn1', 'syn2', 'syn3'], 'name': ['a', 'b', 'c'], 'parentId': 'syn9',
+         'assay': ['wholeGenomeSeq', 'exomeSeq', 'exomeSeq'],
+         'sex': ['male', 'female', None]})
+
+    manifest = pandas.DataFrame({'name': ['a', 'b', 'c', 'd'],
+                                 'parentId': 'syn9',
+                                 'data_file': 's3://nda-bsmn/abc',
+                                 'assay': ['wholeGenomeSeq', 'wholeGenomeSeq',
+                                           'exomeSeq', 'exomeSeq'],
+                                 'sex': ['male', 'female', 'male', 'male']})
+
+    changes = ndasynapse.synapse.update_annotations(syn, manifest, "syn10",
+                                                    chunk_size=1)
+
+    assert changes == {2: {'assay': 'wholeGenomeSeq'}, 3: {'sex': 'male'}}
+    assert_list_equal([c[0][0] for c in mock_from_mapping.call_args_list],
+                      [{2: {'assay': 'wholeGenomeSeq'}}, {3: {'sex': 'male'}}])
+    assert syn.store.call_count == 2
+
+
+def test_get_filehandles_batch_chunks_and_caches():
+    syn = _fake_syn()
+    associations = [{'fileHandleId': i, 'associateObjectId': 'syn%s' % i}
+                    for i in range(250)]
+
+    cache = {}
+    fileHandles = ndasynapse.synapse.get_filehandles_batch(syn, associations,
+                                                           cache=cache)
+
+    assert len(fileHandles) == 250
+    assert syn.restPOST.call_count == 3
+
+    ndasynapse.synapse.get_filehandles_batch(syn, associations[:10], cache=cache)
+    assert syn.restPOST.call_count == 3
+
+
+def test_check_existing_by_datasetid_cache(tmp_path):
+    cache_file = str(tmp_path / "datasetids.json")
+    syn = Mock()
+    syn.tableQuery.return_value.asDataFrame.return_value = pandas.DataFrame(
+        {'id': ['syn1', 'syn2'], 'datasetid': [100, 200], 'modifiedOn': [5, 7]})
+
+    res = ndasynapse.synapse.check_existing_by_datasetid(syn, [100, 300], "syn10",
+                                                         cache_file=cache_file)
+    assert res == {'exists': set([100]), 'not_exists': set([300])}
+
+    # syn2 was changed to another datasetid
+    syn.tableQuery.return_value.asDataFrame.return_value = pandas.DataFrame(
+        {'id': ['syn2'], 'datasetid': [300], 'modifiedOn': [9]})
+
+    res = ndasynapse.synapse.check_existing_by_datasetid(syn, [100, 200, 300], "syn10",
+                                                         cache_file=cache_file)
+
+    assert syn.tableQuery.call_args[0][0] == \
+        'select id,datasetid,modifiedOn from syn10 where modifiedOn >= 7'
+    assert res == {'exists': set([100, 300]), 'not_exists': set([200])}
+
+    # A truncated cache from an interrupted run is rebuilt
+    with open(cache_file, 'w') as f:
+        f.write('{"file_view_id": "syn10", "water')
+
+    ndasynapse.synapse.check_existing_by_datasetid(syn, [100], "syn10",
+                                                   cache_file=cache_file)
+
+    assert syn.tableQuery.call_args[0][0] == 'select id,datasetid,modifiedOn from syn10'
+
+
+def test_slugify_paths():
+    namespace = uuid.UUID('6ba7b810-9dad-11d1-80b4-00c04fd430c8')
+    paths = ['s3://nda-bsmn/abc/file1.bam', 's3://nda-bsmn/def/file1.bam',
+             's3://nda-bsmn/def/fïle2.bam']
+
+    slugs = ndasynapse.synapse.slugify_paths(paths, str(namespace))
+
+    assert_list_equal(slugs, [ndasynapse.synapse.uuid2slug(uuid.uuid3(namespace, x))
+                              for x in paths])
+    assert ndasynapse.synapse.slug2uuid(slugs[0]) == uuid.uuid3(namespace, paths[0])
+
+
+def test_sync_with_fake_synapse():
+    syn = fakesynapse.FakeSynapse()
+    def sync():
+        fh_list = ndasynapse.synapse.create_synapse_filehandles(
+            syn=syn, metadata_manifest=_metadata_manifest,
+            storage_location=_storage_location, parallel=2)
+        synapse_manifest = pandas.DataFrame(
+            {'name': ['file1.bam', 'file2.bam', 'file1.bam'],
+             'parentId': ['syn9', 'syn9', 'syn8'],
+             'dataFileHandleId': [fh.get('id') for fh in fh_list],
+             'assay': 'wholeGenomeSeq'})
+        return ndasynapse.synapse.store(syn, synapse_manifest, fh_list,
+                                        parallel=2, file_view_id="syn10")
+
+    f_list = sync()
+    assert len(syn.entities) == 3 and len(syn.filehandles) == 3
+    assert syn.calls['store'] == 3
+
+    # No new file handles are made the second time. Both md5a rows now get
+    # the same file handle, so only the second file1.bam is stored again.
+    assert_list_equal([f.id for f in sync()], [f.id for f in f_list])
+    assert len(syn.filehandles) == 3
+    assert syn.calls['store'] == 4
+
+
+def test_fake_synapse_failure_injection():
+    syn = fakesynapse.FakeSynapse(
+        fail_on=lambda name, uri: name == 'store' and uri == 'b')
+
+    synapse_manifest = pandas.DataFrame({'name': ['a', 'b', 'c'],
+                                         'parentId': 'syn9',
+                                         'dataFileHandleId': None})
+    filehandles = [{'key': 'a'}, {'key': 'b'}, {'key': 'c'}]
+
+    with assert_raises(fakesynapse.FakeSynapseError):
+        ndasynapse.synapse.store(syn, synapse_manifest, filehandles, parallel=1)
+
+    names = [x['name'] for x in syn.entities.values()]
+    assert names[0] == 'a' and 'b' not in names